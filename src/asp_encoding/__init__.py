@@ -2,4 +2,7 @@ from .asp_utils import sanitize_asp
 from .perfect_information_encoding import encode_scene_perfect
 from .scene_encoding import encode_scene
 from .question_encoding import encode_question
-from .run_clingo import run_clingo
+from .run_clingo import run_clingo, ClingoSession, SOLVER_PROFILES
+from .batch_solver import run_clingo_batch
+from .relevance import slice_scene
+from .solver_cache import SolverCache
@@ -0,0 +1,125 @@
+from multiprocessing.connection import wait
+import multiprocessing
+import os
+import time
+from .run_clingo import ClingoSession
+
+
+def _error_result(status, error, runtime_sec=0.0):
+    return {"answers": [], "status": status, "timeout": status == "timeout", "runtime_sec": runtime_sec, "error": error}
+
+
+def _solve_job(session, distinct, job):
+    scene_encoding, question_encoding, topk, forced_answer = job
+    try:
+        solve = session.solve_topk if distinct else session.solve
+        return solve(scene_encoding, question_encoding, topk=topk, forced_answer=forced_answer)
+    except Exception as e:
+        # clingo reports malformed programs (e.g. broken llm output) as RuntimeError
+        return _error_result("error", f"{type(e).__name__}: {e}")
+
+
+def _worker_loop(connection, timeout, distinct, profile):
+    session = ClingoSession(timeout=timeout, profile=profile)
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        connection.send(_solve_job(session, distinct, job))
+
+
+class _Worker:
+    """Worker process solving one job at a time, sent through a pipe."""
+
+    def __init__(self, context, timeout, distinct, profile):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_worker_loop, args=(child_connection, timeout, distinct, profile),
+                                       daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.index = None
+        self.deadline = None
+
+    def start(self, index, job, kill_after):
+        self.index = index
+        self.deadline = time.monotonic() + kill_after
+        self.connection.send(job)
+
+    def finish(self):
+        index, self.index, self.deadline = self.index, None, None
+        return index
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+    def close(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(1.0)
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.connection.close()
+
+
+def run_clingo_batch(jobs, processes=None, timeout=10.0, distinct=False, profile="default", kill_after=None):
+    """Solves (scene_encoding, question_encoding, topk, forced_answer) jobs on a pool of worker processes.
+
+    Yields (job index, result) pairs in completion order, where result is the dict returned by
+    ClingoSession.solve (ClingoSession.solve_topk if distinct is set). Searches that run into the timeout
+    are cancelled and reported with status "timeout", jobs that clingo cannot parse or ground (or that
+    fail otherwise) with status "error". The timeout of the session only limits the search, so jobs still
+    running after kill_after seconds (default twice the timeout, which leaves the grounding as much time as
+    the search) are killed with their worker, which is replaced, and reported with status "timeout".
+    profile selects the SOLVER_PROFILES entry of the worker sessions.
+    """
+    kill_after = 2 * timeout if kill_after is None else kill_after
+    processes = os.cpu_count() if processes is None else processes
+    context = multiprocessing.get_context()
+    jobs = enumerate(jobs)
+    workers = []
+    pending = True
+    try:
+        while True:
+            while pending:
+                worker = next((worker for worker in workers if worker.index is None), None)
+                if worker is None:
+                    if len(workers) == processes:
+                        break
+                    worker = _Worker(context, timeout, distinct, profile)
+                    workers.append(worker)
+                next_job = next(jobs, None)
+                if next_job is None:
+                    pending = False
+                    break
+                worker.start(*next_job, kill_after)
+
+            busy = [worker for worker in workers if worker.index is not None]
+            if not busy:
+                return
+            remaining = min(worker.deadline for worker in busy) - time.monotonic()
+            ready = wait([worker.connection for worker in busy], max(remaining, 0))
+            for worker in busy:
+                if worker.connection in ready:
+                    try:
+                        result = worker.connection.recv()
+                    except EOFError:
+                        # the worker died, e.g. out of memory during grounding
+                        worker.kill()
+                        workers.remove(worker)
+                        result = _error_result("error", f"worker exited with code {worker.process.exitcode}")
+                    yield worker.finish(), result
+                elif time.monotonic() >= worker.deadline:
+                    worker.kill()
+                    workers.remove(worker)
+                    yield worker.finish(), _error_result("timeout", f"killed after {kill_after} seconds", kill_after)
+    finally:
+        for worker in workers:
+            worker.close()
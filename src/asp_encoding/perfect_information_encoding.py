@@ -2,6 +2,7 @@ from constants import read_concepts
 
 from .question_encoding import encode_question
 from .asp_utils import sanitize_asp
+from .scene_program import SceneProgram
 
 
 class_to_category, value_to_attribute = read_concepts()
@@ -11,33 +12,34 @@ def encode_sample(question):
     return (encode_scene_perfect(question['sceneGraph']), encode_question(question))
 
 
-def encode_scene_perfect(scene_graph):
-    scene_encoding = ""
+def encode_scene_perfect(scene_graph, as_text=False):
+    scene_encoding = SceneProgram()
     for oid, nodeinfo in scene_graph.nodes(data=True):
         if oid  == 'scene':
             continue
 
-        scene_encoding += f"object({oid}).\n"
+        scene_encoding.fact("object", oid)
 
-        scene_encoding += f"has_attr({oid}, class, {sanitize_asp(nodeinfo['name'])}).\n"
-        scene_encoding += f"has_attr({oid}, name, {sanitize_asp(nodeinfo['name'])}).\n"
+        scene_encoding.fact("has_attr", oid, "class", sanitize_asp(nodeinfo['name']))
+        scene_encoding.fact("has_attr", oid, "name", sanitize_asp(nodeinfo['name']))
        
         for category in class_to_category.get(sanitize_asp(nodeinfo['name']), []):
-            scene_encoding += f"has_attr({oid}, class, {category}).\n"    
+            scene_encoding.fact("has_attr", oid, "class", category)
 
         for value in nodeinfo['attributes']:
             if value in value_to_attribute:
                 for att in value_to_attribute[value]:
-                    scene_encoding += f"has_attr({oid}, {sanitize_asp(att)}, {sanitize_asp(value)}).\n"
+                    scene_encoding.fact("has_attr", oid, sanitize_asp(att), sanitize_asp(value))
             else:
-                scene_encoding += f"has_attr({oid}, any, {sanitize_asp(value)}).\n"
+                scene_encoding.fact("has_attr", oid, "any", sanitize_asp(value))
         
-        scene_encoding += f"has_attr({oid}, hposition, {nodeinfo['hposition']}).\n"
-        scene_encoding += f"has_attr({oid}, vposition, {nodeinfo['vposition']}).\n"
+        scene_encoding.fact("has_attr", oid, "hposition", nodeinfo['hposition'])
+        scene_encoding.fact("has_attr", oid, "vposition", nodeinfo['vposition'])
 
         for rel in scene_graph.out_edges(oid, data=True):
-            scene_encoding += f"has_rel({oid}, {sanitize_asp(rel[2]['name'])}, {rel[1]}).\n"
+            scene_encoding.fact("has_rel", oid, sanitize_asp(rel[2]['name']), rel[1])
 
         # for rel in scene_graph.in_edges(oid, data=True):
-        #     scene_encoding += f"has_rel({oid}, {sanitize_asp(rel[2]['name'])}, {rel[0]}).\n"
-    return scene_encoding
+        #     scene_encoding.fact("has_rel", oid, sanitize_asp(rel[2]['name']), rel[0])
+    return scene_encoding.to_asp() if as_text else scene_encoding
+
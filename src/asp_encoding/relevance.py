@@ -0,0 +1,134 @@
+from clingo.symbol import parse_term
+from .scene_program import SceneProgram
+
+# predicates whose second (and third) argument is the step they read the object states from
+UNARY_STEPS = ["select", "filter", "filter_any", "relate", "relate_any", "relate_attr", "query", "unique",
+               "exist", "verify_attr", "verify_rel", "choose_attr", "choose_rel", "all_same", "all_different"]
+BINARY_STEPS = ["two_same", "two_different", "common", "compare", "negate"]
+# predicates that only combine boolean results
+BOOLEAN_STEPS = ["scene", "end", "and", "or"]
+
+HARD_ATTRIBUTES = ["class"]
+
+
+class QuestionRelevance:
+    """Collects which scene atoms the operations of a flat question encoding can read.
+
+    Objects are reachable if one of their classes is selected or related to. Attribute values
+    are relevant if they are queried, filtered, verified, chosen or compared, relations if they
+    are related, verified or chosen. If the encoding cannot be parsed or contains unknown
+    operations, everything is considered relevant.
+    """
+
+    def __init__(self, question_encoding):
+        self.sliceable = True
+        self.all_objects = False
+        self.all_attributes = False
+        self.classes = set()
+        self.attributes = set()
+        self.values = set()
+        self.attr_values = set()
+        self.relations = set()
+
+        statements = []
+        for statement in question_encoding.split("."):
+            if statement.strip() == "":
+                continue
+            try:
+                statements.append(parse_term(statement.strip()))
+            except RuntimeError:
+                self.sliceable = False
+                return
+
+        scene_steps = {str(s.arguments[0]) for s in statements if s.name == "scene"}
+        for statement in statements:
+            op, args = statement.name, [str(arg) for arg in statement.arguments]
+            if op in UNARY_STEPS:
+                input_steps = args[1:2]
+            elif op in BINARY_STEPS:
+                input_steps = args[1:3]
+            elif op in BOOLEAN_STEPS:
+                input_steps = []
+            else:
+                self.sliceable = False
+                return
+
+            # only select restricts the objects of the whole scene by their class
+            if op != "select" and any(step in scene_steps for step in input_steps):
+                self.all_objects = True
+
+            if op == "select":
+                self.classes.add(args[2])
+            elif op == "filter":
+                self.attr_values.add((args[2], args[3]))
+            elif op == "filter_any":
+                self.values.add(args[2])
+            elif op == "relate":
+                self.classes.add(args[2])
+                self.relations.add(args[3])
+            elif op == "relate_any":
+                self.all_objects = True
+                self.relations.add(args[2])
+            elif op == "relate_attr":
+                self.classes.add(args[2])
+                self.attributes.add(args[3])
+            elif op == "query":
+                self.attributes.add(args[2])
+            elif op == "verify_attr":
+                self.attr_values.add((args[2], args[3]))
+            elif op == "verify_rel":
+                self.classes.add(args[2])
+                self.relations.add(args[3])
+            elif op == "choose_attr":
+                self.attr_values.update([(args[2], args[3]), (args[2], args[4])])
+            elif op == "choose_rel":
+                self.classes.add(args[2])
+                self.relations.update([args[3], args[4]])
+            elif op in ["all_same", "all_different", "two_same", "two_different"]:
+                self.attributes.add(args[-1])
+            elif op == "common":
+                self.all_attributes = True
+            elif op == "compare":
+                self.values.add(args[3])
+
+    def reads_attr(self, attr, value):
+        return self.all_attributes or attr in HARD_ATTRIBUTES or attr in self.attributes \
+            or value in self.values or (attr, value) in self.attr_values
+
+    def reads_rel(self, rel):
+        return rel in self.relations
+
+
+def slice_scene(scene_encoding, question_encoding):
+    """Drops the facts and soft atoms of a SceneProgram that no operation of the question encoding can read.
+
+    Dropped soft atoms take their cheaper truth value in every optimal model, so the optimal answers stay
+    the same while the reported costs shrink by a constant.
+    """
+    relevance = QuestionRelevance(question_encoding)
+    if not relevance.sliceable:
+        return scene_encoding
+
+    reachable = None
+    if not relevance.all_objects:
+        reachable = {str(args[0]) for _, predicate, args, *_ in scene_encoding.statements
+                     if predicate == "has_attr" and args[1] == "class" and args[2] in relevance.classes}
+
+    def is_reachable(oid):
+        return reachable is None or str(oid) in reachable
+
+    sliced = SceneProgram()
+    for statement in scene_encoding.statements:
+        predicate, args = statement[1], statement[2]
+        if predicate in ["object", "has_obj_weight"]:
+            keep = is_reachable(args[0])
+        elif predicate == "has_attr":
+            keep = is_reachable(args[0]) and relevance.reads_attr(args[1], args[2])
+        elif predicate == "has_rel":
+            keep = is_reachable(args[0]) and is_reachable(args[2]) and relevance.reads_rel(args[1])
+        else:
+            keep = True
+
+        if keep:
+            sliced.statements.append(statement)
+    return sliced
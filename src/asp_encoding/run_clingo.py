@@ -1,40 +1,371 @@
 from clingo.control import Control
-from .asp_utils import sanitize
+from clingo.core import MessageCode
+from clingo.ast import ProgramBuilder, parse_string
+from clingo.symbol import Function
+from .asp_utils import sanitize_asp
+from .scene_program import SceneProgram
+from .relevance import slice_scene
+from .solver_cache import content_key
+import time
+import sys
 import os
 
-def run_clingo(scene_encoding, question_encoding, topk=1, forced_answer=None):
-    ctl = Control()
-    # ctl.configuration.solver.opt_strategy = "usc,3"
-    
-    with open(os.path.join(os.path.dirname(__file__), "theory.lp")) as theory_file:
-        lp = theory_file.read()
-
-    lp += "\n% ------ scene encoding ------\n"
-    lp += scene_encoding
-    lp += "\n% ------ question encoding ------\n"
-    lp += question_encoding
-
-    if forced_answer is not None:
-        lp += "\n% ------ forced answer ------\n"
-        if forced_answer == "front":
-            forced_answer = "in_front_of"
-        elif forced_answer == "left":
-            forced_answer = "to_the_left_of"
-        elif forced_answer == "right":
-            forced_answer = "to_the_right_of"
-
-        lp += f":~ not ans({sanitize(forced_answer)}). [1@2]"
-
-    
-    # with open("full.lp", "w") as f:
-    #     f.write(lp)
-    ctl.add(lp)
-    answers = []
-    def on_model(model):
-        for s in model.symbols(shown=True):
-            answers.append(s.arguments[0].name)
-
-    ctl.ground()
-    handle = ctl.solve(on_model=on_model, async_ = True)
-    handle.wait(timeout=10.0)
-    return answers[-topk:]
+THEORY_PATH = os.path.join(os.path.dirname(__file__), "theory.lp")
+
+# named clingo command line configurations, see `clingo --help=3` for the options
+SOLVER_PROFILES = {
+    "default": [],
+    # core guided optimization, usually faster at proving optimality than branch and bound
+    "usc": ["--opt-strategy=usc,3"],
+    "bb_dec": ["--opt-strategy=bb,dec"],
+    # prefer assigning the atoms of the weak constraints (minimize statements, pick "opt") false first
+    "domain_min": ["--heuristic=Domain", "--dom-mod=false,opt"],
+    "vsids": ["--heuristic=Vsids"],
+    "trendy": ["--configuration=trendy"],
+    # portfolio of 4 competing solver threads
+    "parallel": ["--parallel-mode=4,compete", "--configuration=many"],
+    "parallel_usc": ["--parallel-mode=4,compete", "--opt-strategy=usc,3"],
+}
+
+
+def _log_message(code, message):
+    # opening the backend checks the program before the scene atoms exist,
+    # which makes clingo report the #show'n ans/1 as undefined
+    if code == MessageCode.AtomUndefined and message.endswith("no atoms over signature occur in program:\n  ans/1\n"):
+        return
+    print(message, file=sys.stderr)
+
+
+def answer_constant(answer):
+    """Maps a gqa answer to the constant the theory derives in ans/1."""
+    if answer == "front":
+        answer = "in_front_of"
+    elif answer == "left":
+        answer = "to_the_left_of"
+    elif answer == "right":
+        answer = "to_the_right_of"
+    return sanitize_asp(answer)
+
+
+def forced_answer_constraint(forced_answer):
+    return f":~ not ans({answer_constant(forced_answer)}). [1@2]"
+
+
+class _WeakConstraintCounter:
+    """Ground program observer counting the literals of the minimize statements, i.e. the ground weak constraints."""
+
+    def __init__(self):
+        self.count = 0
+
+    def minimize(self, priority, literals):
+        self.count += len(literals)
+
+
+def _search_statistics(ctl):
+    solvers = ctl.statistics["solving"]["solvers"]
+    return int(solvers["choices"]), int(solvers["conflicts"])
+
+
+def _statistics(ctl, counter, ground_sec, solve_sec, search):
+    lp = ctl.statistics["problem"]["lp"]
+    return {
+        "atoms": int(lp["atoms"]),
+        "rules": int(lp["rules"]),
+        "weak_constraints": counter.count,
+        "choices": search[0],
+        "conflicts": search[1],
+        "ground_sec": ground_sec,
+        "solve_sec": solve_sec,
+    }
+
+
+class ClingoSession:
+    """Solver session that reads and parses theory.lp once per process.
+
+    The theory rules range over the scene and question facts, so every question is still
+    grounded in a fresh control, but the parsed theory statements are reused instead of
+    reading and parsing the file again. With slice_scene set, SceneProgram encodings are
+    reduced to the atoms the question can read before grounding (see relevance.slice_scene).
+    With a SolverCache, results are looked up by the content of the theory, the encodings
+    and the solver options, and cache hits skip clingo entirely. soft_encoding selects how the
+    soft atoms of SceneProgram encodings are weighted (see SceneProgram.add_to_control).
+    profile names the SOLVER_PROFILES entry used by default, every solve method can override it.
+    """
+
+    def __init__(self, theory_path=THEORY_PATH, timeout=10.0, slice_scene=False, cache=None, soft_encoding="pair",
+                 profile="default"):
+        with open(theory_path) as theory_file:
+            self.theory = theory_file.read()
+        self.timeout = timeout
+        self.slice_scene = slice_scene
+        self.cache = cache
+        self.soft_encoding = soft_encoding
+        self.profile = profile
+        self.solver_arguments(profile)
+
+        self._theory_key = content_key(self.theory)
+        self._theory_statements = []
+        parse_string(self.theory, self._theory_statements.append)
+
+    def solver_arguments(self, profile=None):
+        """Returns the clingo arguments of the given profile (the session profile if None)."""
+        profile = self.profile if profile is None else profile
+        if profile not in SOLVER_PROFILES:
+            raise ValueError(f"unknown solver profile {profile}, choose one of {list(SOLVER_PROFILES)}")
+        return SOLVER_PROFILES[profile]
+
+    def options(self, profile=None):
+        """Solver options that can change the result of a solve call."""
+        return {"timeout": self.timeout, "slice_scene": self.slice_scene, "soft_encoding": self.soft_encoding,
+                "solver_arguments": self.solver_arguments(profile)}
+
+    def _cache_key(self, method, scene_encoding, question_encoding, profile=None, **params):
+        if self.cache is None:
+            return None
+        if isinstance(scene_encoding, SceneProgram):
+            scene_key = scene_encoding.digest()
+        else:
+            scene_key = content_key(scene_encoding)
+        return content_key(method, self._theory_key, scene_key, question_encoding, params, self.options(profile))
+
+    def _cache_lookup(self, key):
+        return self.cache.get(key) if key is not None else None
+
+    def _cache_store(self, key, result):
+        # timeouts depend on the load of the machine, only completed solves are stored
+        if key is not None and result["status"] != "timeout":
+            self.cache.put(key, result)
+
+    def control(self, scene_encoding, question_encoding, forced_answer=None, observer=None, profile=None):
+        ctl = Control(self.solver_arguments(profile), logger=_log_message)
+        if observer is not None:
+            ctl.register_observer(observer)
+        with ProgramBuilder(ctl) as builder:
+            for statement in self._theory_statements:
+                builder.add(statement)
+
+        if isinstance(scene_encoding, SceneProgram):
+            if self.slice_scene:
+                scene_encoding = slice_scene(scene_encoding, question_encoding)
+        else:
+            # added on its own, so the scene text is not copied into one program string
+            ctl.add(scene_encoding)
+        ctl.add(self._question_program(question_encoding, forced_answer))
+
+        # the backend is opened last, all parsed statements have to be added before
+        if isinstance(scene_encoding, SceneProgram):
+            scene_encoding.add_to_control(ctl, soft_encoding=self.soft_encoding)
+        return ctl
+
+    def _question_program(self, question_encoding, forced_answer=None):
+        if forced_answer is None:
+            return question_encoding
+        return f"{question_encoding}\n% ------ forced answer ------\n{forced_answer_constraint(forced_answer)}"
+
+    def write_program(self, sink, scene_encoding, question_encoding, forced_answer=None):
+        """Writes the full program that control grounds (theory, scene and question) to a file-like sink, e.g. for
+        debugging it with the clingo command line. SceneProgram encodings are streamed in chunks."""
+        sink.write(self.theory)
+        sink.write("\n% ------ scene encoding ------\n")
+        if isinstance(scene_encoding, SceneProgram):
+            if self.slice_scene:
+                scene_encoding = slice_scene(scene_encoding, question_encoding)
+            scene_encoding.write_asp(sink, soft_encoding=self.soft_encoding)
+        else:
+            sink.write(scene_encoding)
+        sink.write("\n% ------ question encoding ------\n")
+        sink.write(self._question_program(question_encoding, forced_answer))
+        sink.write("\n")
+
+    def _solve(self, ctl, on_model, timeout, assumptions=()):
+        """Runs one solve call and cancels it once the timeout is reached. Returns the status ("ok", "unsat" or "timeout")."""
+        with ctl.solve(assumptions=assumptions, on_model=on_model, async_ = True) as handle:
+            if not handle.wait(timeout):
+                # stop the search instead of leaving it running in the background
+                handle.cancel()
+                return "timeout"
+            return "unsat" if handle.get().unsatisfiable else "ok"
+
+    def solve(self, scene_encoding, question_encoding, topk=1, forced_answer=None, statistics=False, profile=None):
+        """Returns the answers together with the solve status ("ok", "unsat" or "timeout") and the runtime.
+
+        With statistics set, the result also holds the ground program size (atoms, rules, weak constraints),
+        the search effort (choices, conflicts) and the ground and solve wall times. The ground time includes
+        setting up the control, i.e. adding the theory, question and scene encoding.
+        """
+        key = self._cache_key("solve", scene_encoding, question_encoding, profile, topk=topk, forced_answer=forced_answer,
+                              statistics=statistics)
+        cached = self._cache_lookup(key)
+        if cached is not None:
+            return cached
+
+        start = time.perf_counter()
+        counter = _WeakConstraintCounter() if statistics else None
+        ground_start = time.perf_counter()
+        ctl = self.control(scene_encoding, question_encoding, forced_answer, observer=counter, profile=profile)
+        answers = []
+        def on_model(model):
+            for s in model.symbols(shown=True):
+                answers.append(s.arguments[0].name)
+
+        ctl.ground()
+        solve_start = time.perf_counter()
+        status = self._solve(ctl, on_model, self.timeout)
+
+        result = {
+            "answers": answers[-topk:],
+            "status": status,
+            "timeout": status == "timeout",
+            "runtime_sec": time.perf_counter() - start,
+        }
+        if statistics:
+            result["statistics"] = _statistics(ctl, counter, solve_start - ground_start, time.perf_counter() - solve_start,
+                                               _search_statistics(ctl))
+        self._cache_store(key, result)
+        return result
+
+    def solve_topk(self, scene_encoding, question_encoding, topk=1, forced_answer=None, time_budget=None, statistics=False,
+                   profile=None):
+        """Returns up to topk distinct answers ordered by the cost of their best model.
+
+        The program is grounded once. After each optimal answer is found it is assumed false and the
+        optimization is repeated, until topk answers are proven, no further answer exists or the time
+        budget (defaults to the session timeout) runs out. On a timeout the best answer found so far
+        in the interrupted optimization is kept. Statistics are reported as for solve, with the search
+        effort summed over all optimizations.
+        """
+        key = self._cache_key("solve_topk", scene_encoding, question_encoding, profile, topk=topk, forced_answer=forced_answer,
+                              time_budget=time_budget, statistics=statistics)
+        cached = self._cache_lookup(key)
+        if cached is not None:
+            return cached
+
+        start = time.perf_counter()
+        time_budget = self.timeout if time_budget is None else time_budget
+        counter = _WeakConstraintCounter() if statistics else None
+        ground_start = time.perf_counter()
+        ctl = self.control(scene_encoding, question_encoding, forced_answer, observer=counter, profile=profile)
+        ctl.ground()
+        solve_start = time.perf_counter()
+
+        best_model = []
+        def on_model(model):
+            best_model[:] = [model.symbols(shown=True), model.cost]
+
+        answers, costs, excluded = [], [], []
+        choices, conflicts = 0, 0
+        status = "ok"
+        while len(answers) < topk:
+            remaining = time_budget - (time.perf_counter() - start)
+            if remaining <= 0:
+                status = "timeout"
+                break
+
+            best_model.clear()
+            solve_status = self._solve(ctl, on_model, remaining, assumptions=[-literal for literal in excluded])
+            if statistics:
+                step_choices, step_conflicts = _search_statistics(ctl)
+                choices, conflicts = choices + step_choices, conflicts + step_conflicts
+            if not best_model:
+                # every remaining answer is excluded (or the question is unsatisfiable to begin with)
+                status = solve_status if len(answers) == 0 else status
+                break
+
+            symbols, cost = best_model
+            for symbol in symbols:
+                if symbol.arguments[0].name not in answers:
+                    answers.append(symbol.arguments[0].name)
+                    costs.append(cost)
+                excluded.append(ctl.symbolic_atoms[symbol].literal)
+
+            if solve_status == "timeout":
+                status = solve_status
+                break
+
+        result = {
+            "answers": answers[:topk],
+            "costs": costs[:topk],
+            "status": status,
+            "timeout": status == "timeout",
+            "runtime_sec": time.perf_counter() - start,
+        }
+        if statistics:
+            result["statistics"] = _statistics(ctl, counter, solve_start - ground_start, time.perf_counter() - solve_start,
+                                               (choices, conflicts))
+        self._cache_store(key, result)
+        return result
+
+
+    def score_answers(self, scene_encoding, question_encoding, candidates, statistics=False, profile=None):
+        """Returns the optimal cost of the question under each candidate answer.
+
+        The program is grounded once without a forced answer, each candidate is then evaluated by a
+        solve call that assumes its ans/1 atom to be true. Candidates that cannot be derived in the
+        ground program get the cost None. Each candidate solve is limited by the session timeout,
+        after a timeout the cost of the best model found so far is reported.
+        """
+        key = self._cache_key("score_answers", scene_encoding, question_encoding, profile, candidates=list(candidates),
+                              statistics=statistics)
+        cached = self._cache_lookup(key)
+        if cached is not None:
+            return cached
+
+        start = time.perf_counter()
+        counter = _WeakConstraintCounter() if statistics else None
+        ground_start = time.perf_counter()
+        ctl = self.control(scene_encoding, question_encoding, observer=counter, profile=profile)
+        ctl.ground()
+        solve_start = time.perf_counter()
+
+        best_cost = []
+        def on_model(model):
+            best_cost[:] = [model.cost]
+
+        costs = []
+        choices, conflicts = 0, 0
+        status = "ok"
+        for candidate in candidates:
+            atom = ctl.symbolic_atoms[Function("ans", [Function(answer_constant(candidate))])]
+            if atom is None:
+                costs.append(None)
+                continue
+
+            best_cost.clear()
+            if self._solve(ctl, on_model, self.timeout, assumptions=[atom.literal]) == "timeout":
+                status = "timeout"
+            costs.append(best_cost[0] if best_cost else None)
+            if statistics:
+                step_choices, step_conflicts = _search_statistics(ctl)
+                choices, conflicts = choices + step_choices, conflicts + step_conflicts
+
+        result = {
+            "costs": costs,
+            "status": status,
+            "timeout": status == "timeout",
+            "runtime_sec": time.perf_counter() - start,
+        }
+        if statistics:
+            result["statistics"] = _statistics(ctl, counter, solve_start - ground_start, time.perf_counter() - solve_start,
+                                               (choices, conflicts))
+        self._cache_store(key, result)
+        return result
+
+_default_session = None
+
+def default_session():
+    global _default_session
+    if _default_session is None:
+        _default_session = ClingoSession()
+    return _default_session
+
+
+def run_clingo(scene_encoding, question_encoding, topk=1, forced_answer=None, distinct=False, statistics=False, profile=None):
+    """Returns the answers of the last topk improving models, or with distinct set the topk best distinct answers.
+    With statistics set, a tuple of the answers and the solver statistics is returned. profile selects one of
+    the SOLVER_PROFILES."""
+    solve = default_session().solve_topk if distinct else default_session().solve
+    result = solve(scene_encoding, question_encoding, topk=topk, forced_answer=forced_answer, statistics=statistics,
+                   profile=profile)
+    if statistics:
+        return result["answers"], result["statistics"]
+    return result["answers"]
@@ -1,14 +1,19 @@
-from torchvision.io import read_image, ImageReadMode
 from torchvision.transforms.functional import crop, resize, pad
+from torchvision.ops import roi_align
 from gs_vqa.pipeline.concept_extraction import extract_attributes, extract_classes, extract_relations
 from gs_vqa.pipeline.bounding_box_optimization import get_object_bboxes, get_pair_bboxes
+from gs_vqa.pipeline.detection_merging import category_index, merge_detected_objects
 from gs_vqa.gs_vqa_utils import cleanup_whitespace, sanitize_asp
+from gs_vqa.image_loader import load_image
 from constants import GQA_DATAPATH
 from .blind_concept_extractor import extract_attributes_blind, extract_classes_blind, extract_relations_blind
+from .scene_program import SceneProgram
+import numpy as np
 import math
 import torch
 import json
 import itertools 
+import time
 import os
 
 
@@ -18,23 +23,29 @@ with open(os.path.join(GQA_DATAPATH, "metadata", "gqa_all_attribute.json")) as f
 with open(os.path.join(GQA_DATAPATH, "metadata", "gqa_all_class.json")) as f:
     all_classes = json.load(f)
     all_child_classes = [c.replace("_", " ") for c in itertools.chain(*all_classes.values())]
+    class_categories = category_index(all_classes)
 
 
 
+def crop_box(bbox):
+    """Integer (y, x, h, w) region that bboxes_to_image_crops cuts out for a (y1, x1, y2, x2) box, at least one pixel."""
+    return int(bbox[0]), int(bbox[1]), max(int(bbox[2]-bbox[0]), 1), max(int(bbox[3]-bbox[1]), 1)
+
+
 def bboxes_to_image_crops(bboxes, image, model, mode="pad"):
     bbox_crops = []
     for bbox in bboxes:
-        y, x, h, w = int(bbox[0]), int(bbox[1]), int(bbox[2]-bbox[0]), int(bbox[3]-bbox[1])
+        y, x, h, w = crop_box(bbox)
         bbox_crop = crop(image, y, x, h, w)
 
         if mode == "pad":
             # resize and scale (maintain aspect ratio)
             if h > w:
                 resize_dimensions = (
-                    model.img_size, 2*round((model.img_size*w/h)/2))
+                    model.img_size, max(2*round((model.img_size*w/h)/2), 2))
             else:
                 resize_dimensions = (
-                    2*round((model.img_size*h/w)/2), model.img_size)
+                    max(2*round((model.img_size*h/w)/2), 2), model.img_size)
             bbox_crop = resize(bbox_crop, resize_dimensions, antialias=True)
 
             # pad the image to square dimensions
@@ -53,72 +64,178 @@ def bboxes_to_image_crops(bboxes, image, model, mode="pad"):
     return bbox_crops
 
 
+def bboxes_to_pixel_values(bboxes, image, model, mode="pad"):
+    """Vectorized bboxes_to_image_crops, returns the normalized (N, 3, img_size, img_size) input of the vision tower.
+
+    All crops are cut out and resized by one roi_align call on the image. For mode "pad" the sampled region is
+    widened by the padding of bboxes_to_image_crops and the padding is zeroed afterwards. roi_align averages
+    the samples of each output pixel instead of antialiased resizing, so the crops match up to interpolation.
+    """
+    size = model.img_size
+    y, x, h, w = torch.tensor([crop_box(bbox) for bbox in bboxes], dtype=torch.float64).unbind(1)
+    if mode == "pad":
+        # size of the resized crop as in bboxes_to_image_crops, centered in the padded square
+        content_h = torch.where(h > w, size, (2*torch.round(size*h/w/2)).clamp(min=2))
+        content_w = torch.where(h > w, (2*torch.round(size*w/h/2)).clamp(min=2), size)
+        top, left = (size - content_h) // 2, (size - content_w) // 2
+        y1, y2 = y - top*h/content_h, y + h + (size - content_h - top)*h/content_h
+        x1, x2 = x - left*w/content_w, x + w + (size - content_w - left)*w/content_w
+    elif mode == "scale":
+        y1, x1, y2, x2 = y, x, y + h, x + w
+    else:
+        raise RuntimeError("Unsupported image processing mode!")
+
+    rois = torch.stack([torch.zeros_like(x1), x1, y1, x2, y2], dim=1).to(model.gpu, torch.float32)
+    crops = roi_align(image[None].to(model.gpu, torch.float32), rois, output_size=size, spatial_scale=1.0, aligned=True)
+
+    if mode == "pad":
+        pixels = torch.arange(size)
+        rows = (pixels >= top[:, None]) & (pixels < (top + content_h)[:, None])
+        cols = (pixels >= left[:, None]) & (pixels < (left + content_w)[:, None])
+        crops = crops * (rows[:, None, :, None] & cols[:, None, None, :]).to(crops.device)
+
+    return model.normalize_images(crops)
+
+
+def crop_features(image, image_id, bboxes, model, mode="pad", vectorized=False):
+    """Image features of the crops of bboxes, cached in model.image_cache by (model id, image id, crop method, crop box).
+
+    The crop box is the integer region the crop is cut from, so equal keys always give equal crops. Only the
+    crops missing in the cache are cut out and encoded, with bboxes_to_pixel_values if vectorized is set and
+    with bboxes_to_image_crops and the image processor of the model otherwise. vectorized is off by default
+    until its effect on the answer accuracy of the pipeline is measured.
+    """
+    method = f"{mode}_roi_align" if vectorized else mode
+    keys = [(model.model_id, image_id, method, *crop_box(bbox)) for bbox in bboxes]
+    def encode(missing_keys):
+        missing_bboxes = [(y, x, y+h, x+w) for *_, y, x, h, w in missing_keys]
+        if vectorized:
+            return model.get_pixel_features(bboxes_to_pixel_values(missing_bboxes, image, model, mode))
+        return model.get_image_features(bboxes_to_image_crops(missing_bboxes, image, model, mode))
+    return model.image_cache.get_or_compute(keys, encode, device=model.gpu)
+
+
 def prob_to_asp_weight(prob):
     return int(min(-1000*math.log(prob), 5000))
 
-def __should_merge__(box1, box2, overlap_threshold):
-        YA1, XA1, YA2, XA2 = box1 
-        YB1, XB1, YB2, XB2 = box2
-        box1_area = (YA2 - YA1) * (XA2 - XA1)
-        box2_area = (YB2 - YB1) * (XB2 - XB1)
-        intersection_area = max(0, min(XA2, XB2) - max(XA1, XB1)) * max(0, min(YA2, YB2) - max(YA1, YB1))
-        union_area = box1_area + box2_area - intersection_area
-
-        if intersection_area / union_area > overlap_threshold:
-            return True, (
-                min(box1[0], box2[0]),
-                min(box1[1], box2[1]),
-                max(box1[2], box2[2]),
-                max(box1[3], box2[3]),
-            )
-
-        return False, None
-
-def merge_detected_objects(objects_a, objects_b):
-    objects = [*objects_a]
-    for ob in objects_b:
-        alread_present = False
-        for oa in objects_a:
-            categories_a = {cat for cat in all_classes if oa["name"] in all_classes[cat]}
-            categories_b = {cat for cat in all_classes if ob["name"] in all_classes[cat]}
-            if len(categories_a & categories_b) > 0:
-                is_merge, _ = __should_merge__(
-                        (oa['y'], oa['x'], oa['y']+oa['h'], oa['x']+oa['w']), 
-                        (ob['y'], ob['x'], ob['y']+ob['h'], ob['x']+ob['w']), 
-                        overlap_threshold=0.7
-                    )
-                if is_merge:
-                    alread_present = True
-        if not alread_present:
-            objects.append(ob)
+def probs_to_asp_weights(probs):
+    """prob_to_asp_weight of every entry of a tensor of probabilities, as a numpy int array."""
+    with np.errstate(divide="ignore"):
+        return np.minimum(-1000*np.log(probs.cpu().numpy().astype(np.float64)), 5000).astype(np.int64)
 
-    return objects
+def soft_asp_weights(logits, neutral_logits):
+    """ASP weights of soft atoms scored by prompts that compete with a neutral prompt.
 
+    Each logit is turned into the probability of the atom by a softmax against the neutral logit (broadcast to
+    the shape of logits). Returns the integer weights of the atom being true and false.
+    """
+    probs = torch.nn.functional.softmax(torch.stack([logits, neutral_logits.expand_as(logits)]), dim=0)
+    return probs_to_asp_weights(probs[0]), probs_to_asp_weights(probs[1])
 
 def get_article(name):
     return "an" if any(name.startswith(v) for v in ["a", "e", "i", "o", "u"]) else "a"
 
 
-def detect_objects_question_driven(image, classes, object_detector, threshold=0.03, k=5):
+def relation_prompts(object1, object2, relations):
+    """Prompts for object1 being in each relation to object2, followed by the neutral prompt naming both."""
+    subject = f"{get_article(object1['name'])} {object1['name']}"
+    target = f"{get_article(object2['name'])} {object2['name']}"
+    return [*[f"{subject} {rel} {target}" for rel in relations], f"{subject} and {target}"]
+
+
+def attribute_prompts(obj, values):
+    """Neutral prompt naming obj, followed by the prompts for obj having each value."""
+    return [f"a pixelated picture of {get_article(obj['name'])} {obj['name']}",
+            *[f"a pixelated picture of {get_article(val)} {val} {obj['name']}" for val in values]]
+
+
+def score_attributes(model, obj_features, objects, values):
+    """Returns the logits of attribute_prompts(objects[o], values) on the crop of every object o, shape [n, len(values) + 1].
+
+    obj_features are the image features of the object crops. Every distinct prompt is encoded once.
+    """
+    object_prompts = [attribute_prompts(obj, values) for obj in objects]
+    prompt_indices = {}
+    for prompts in object_prompts:
+        for prompt in prompts:
+            prompt_indices.setdefault(prompt, len(prompt_indices))
+
+    text_features = model.get_text_features(list(prompt_indices))
+    text_index = torch.tensor([[prompt_indices[prompt] for prompt in prompts] for prompts in object_prompts], device=text_features.device)
+    return model.score_features(obj_features.unsqueeze(1), text_features[text_index])
+
+
+def score_relations(model, rel_features, rel_bbox_indices, objects, relations):
+    """Returns the logits of the relation prompts of every ordered object pair (o1, o2) on the crop of the pair.
+
+    rel_features are the image features of the pair crops. Entry [o1, o2, :] holds the logits of
+    relation_prompts(objects[o1], objects[o2], relations). Every distinct prompt is encoded once, and only
+    the logits of a pair crop with the prompts of its pairs are computed.
+    """
+    num_objects = len(objects)
+    pairs = [(o1, o2) for o1 in range(num_objects) for o2 in range(num_objects) if o1 != o2]
+    pair_prompts = [relation_prompts(objects[o1], objects[o2], relations) for o1, o2 in pairs]
+
+    prompt_indices = {}
+    for prompts in pair_prompts:
+        for prompt in prompts:
+            prompt_indices.setdefault(prompt, len(prompt_indices))
+
+    text_features = model.get_text_features(list(prompt_indices))
+
+    crop_index = torch.tensor([int(rel_bbox_indices[o1, o2]) for o1, o2 in pairs], device=rel_features.device)
+    text_index = torch.tensor([[prompt_indices[prompt] for prompt in prompts] for prompts in pair_prompts], device=text_features.device)
+    pair_logits = model.score_features(rel_features[crop_index].unsqueeze(1), text_features[text_index])
+
+    rel_logits = torch.zeros((num_objects, num_objects, len(relations) + 1), device=pair_logits.device)
+    rel_logits[[o1 for o1, _ in pairs], [o2 for _, o2 in pairs]] = pair_logits
+    return rel_logits
+
+
+def precompute_query_embeddings(object_detector):
+    """Encodes the class and category names of the GQA vocabulary into the query cache of the detector
+    (see OWLViTObjectDetector.embed_queries), so detection only runs the image side."""
+    object_detector.embed_queries([*all_child_classes, *[category.replace("_", " ") for category in all_classes]])
+
+
+def detect_objects_question_driven(image, classes, object_detector, threshold=0.03, k=5, detection_index=None, image_id=None):
+    """Detects the objects of the classes and categories of a question. If the image is in the detection_index,
+    the query groups the index covers are read from it and only the others are passed to the detector. An index
+    built with another detector model (or inference mode) is not used."""
     threshold = 0.03
+    # one query group per class, per category and for all classes, detected in one pass over the image
+    class_groups = [([clazz.replace("_", " ")], threshold, k) for clazz in classes["classes"]]
+    category_groups = [([c.replace("_", " ") for c in all_classes[category]], threshold, k) for category in classes["categories"]]
+    all_groups = [(all_child_classes, threshold, 5*k)] if classes["all"] else []
+    query_groups = [*class_groups, *category_groups, *all_groups]
+
+    if detection_index is not None and detection_index.matches(object_detector) and image_id in detection_index:
+        indexed = [detection_index.covers(group) for group in query_groups]
+        detected = []
+        if not all(indexed):
+            detected = object_detector.detect_object_groups(image, [group for group, i in zip(query_groups, indexed) if not i])
+        looked_up = detection_index.detect_object_groups(image_id, [group for group, i in zip(query_groups, indexed) if i])
+        looked_up, detected = iter(looked_up), iter(detected)
+        groups_objects = [next(looked_up) if i else next(detected) for i in indexed]
+    else:
+        groups_objects = object_detector.detect_object_groups(image, query_groups)
+
     objects = []
-    for clazz in classes["classes"]:
-        detected_objects = object_detector.detect_objects(image, [clazz.replace("_", " ")], threshold=threshold, k=k)
+    for detected_objects in groups_objects[:len(class_groups)]:
         objects.extend(detected_objects)
 
-    for category in classes["categories"]:
-        detected_objects = object_detector.detect_objects(image, [c.replace("_", " ") for c in all_classes[category]], threshold=threshold, k=k)
-        objects = merge_detected_objects(objects, detected_objects)
-
-    if classes["all"]:
-        detected_objects = object_detector.detect_objects(image, all_child_classes, threshold=threshold, k=5*k)
-        objects = merge_detected_objects(objects, detected_objects)
+    for detected_objects in groups_objects[len(class_groups):]:
+        objects = merge_detected_objects(objects, detected_objects, class_categories)
     return objects
 
 @torch.no_grad()
-def encode_scene(question, model, object_detector, blind=False, question_enc=None, k=5, threshold=0.03, merge_threshold=0.6):
-    """Generates scene encoding. If blind is set to True, the question encoding in flat asp format needs to be passed."""
-    scene_encoding = ""
+def encode_scene(question, model, object_detector, blind=False, question_enc=None, k=5, threshold=0.03, merge_threshold=0.6, as_text=False,
+                 detection_index=None, image_loader=None, objects=None, timings=None):
+    """Generates scene encoding as a SceneProgram, or as ASP text if as_text is set. If blind is set to True, the question encoding in flat asp format needs to be passed.
+    With a DetectionIndex, objects of indexed images are looked up instead of detected. With an ImageLoader, the image is taken from it instead of decoded here.
+    Passed objects (as detect_objects_question_driven returns them) are encoded instead of detecting any. A timings dict is filled with
+    the seconds of scoring the attributes (attribute_sec) and relations (relation_sec) of the objects, for the ones that are scored."""
+    scene_encoding = SceneProgram()
     if blind:
         if question_enc is None:
             raise ValueError("Blind mode requires a question encoding to be passed!")
@@ -131,149 +248,83 @@ def encode_scene(question, model, object_detector, blind=False, question_enc=Non
         relations = extract_relations(question)
         
     num_attr_values = sum(len(all_attributes.get(attr, [])) for attr in attributes)
-    num_standalone_values = len(standalone_values)
     num_relations = len(relations)
 
     for attr in attributes:
-        scene_encoding += f"is_attr({cleanup_whitespace(attr)}).\n"
+        scene_encoding.fact("is_attr", cleanup_whitespace(attr))
         for val in all_attributes.get(attr, []):
-            scene_encoding += f"is_attr_value({cleanup_whitespace(attr)}, {cleanup_whitespace(val)}).\n"
-        scene_encoding += "\n"
+            scene_encoding.fact("is_attr_value", cleanup_whitespace(attr), cleanup_whitespace(val))
 
-    scene_encoding += "\n"
-
-    image = read_image(os.path.join(GQA_DATAPATH, "images", f"{question['imageId']}.jpg"), ImageReadMode.RGB)
+    image = image_loader.load(question["imageId"]) if image_loader is not None else load_image(question["imageId"])
     image_size = {'w': image.shape[2], 'h': image.shape[1]}
 
-    objects = detect_objects_question_driven(image, classes, object_detector, k=k, threshold=threshold)
+    if objects is None:
+        objects = detect_objects_question_driven(image, classes, object_detector, k=k, threshold=threshold,
+                                                 detection_index=detection_index, image_id=question["imageId"])
     object_items = [(f"o{i}", o) for i, o in enumerate(objects)]
-    num_objects = len(objects)
 
+    attr_atoms = [(cleanup_whitespace(attr), cleanup_whitespace(val)) for attr in attributes for val in all_attributes.get(attr, [])]
+    standalone_atoms = [("any", cleanup_whitespace(val)) for val in standalone_values]
+    rel_names = [cleanup_whitespace(rel) for rel in relations]
+
+    # ASP weights (true, false) of all soft atoms as nested lists of ints, emitted per object below
     if (len(attributes) > 0 or len(standalone_values) > 0) and len(objects) > 0:
+        start = time.perf_counter()
         object_bboxes = get_object_bboxes(objects, image_size)
-        obj_bbox_crops = bboxes_to_image_crops(object_bboxes, image, model)
-       
-        neutral_prompts = [f"a pixelated picture of {get_article(obj['name'])} {obj['name']}" for obj in objects]
-        attr_prompts = [f"a pixelated picture of {get_article(val)} {val} {obj['name']}"
-                        for obj in objects
-                        for attr in attributes
-                        for val in all_attributes.get(attr, [])]
-        standalone_value_prompts = [f"a pixelated picture of {get_article(val)} {val} {obj['name']}"
-                                    for obj in objects
-                                    for val in standalone_values]
-        
-        obj_logits_per_image = model.score(obj_bbox_crops, [*neutral_prompts, *attr_prompts, *standalone_value_prompts])
-            
+        obj_features = crop_features(image, question["imageId"], object_bboxes, model)
+        values = [val for attr in attributes for val in all_attributes.get(attr, [])]
+        obj_logits = score_attributes(model, obj_features, objects, [*values, *standalone_values])
+        attr_weights = [w.tolist() for w in soft_asp_weights(obj_logits[:, 1:1+num_attr_values], obj_logits[:, :1])]
+        standalone_weights = [w.tolist() for w in soft_asp_weights(obj_logits[:, 1+num_attr_values:], obj_logits[:, :1])]
+        if timings is not None:
+            timings["attribute_sec"] = time.perf_counter() - start
+
     if len(relations) > 0 and len(objects) > 1:
+        start = time.perf_counter()
         rel_bboxes, rel_bbox_indices = get_pair_bboxes(objects, merge_threshold=merge_threshold)
-        rel_bbox_crops = bboxes_to_image_crops(rel_bboxes, image, model)
-    
+        rel_features = crop_features(image, question["imageId"], rel_bboxes, model)
+        rel_logits = score_relations(model, rel_features, rel_bbox_indices, objects, relations)
+        rel_weights = [w.tolist() for w in soft_asp_weights(rel_logits[:, :, :num_relations], rel_logits[:, :, num_relations:])]
+        if timings is not None:
+            timings["relation_sec"] = time.perf_counter() - start
+
     # add attributes derived from object detection (names, vposition/hposition)
     for o1, (oid1, object1) in enumerate(object_items):
-        scene_encoding += f"object({oid1}).\n"
-        scene_encoding += f"has_obj_weight({oid1}, {prob_to_asp_weight(object1['score'])}).\n"
+        scene_encoding.fact("object", oid1)
+        scene_encoding.fact("has_obj_weight", oid1, prob_to_asp_weight(object1['score']))
 
-        scene_encoding += f"has_attr({oid1}, class, {sanitize_asp(object1['name'])}).\n"
+        scene_encoding.fact("has_attr", oid1, "class", sanitize_asp(object1['name']))
         for category in all_classes: 
             if sanitize_asp(object1["name"]) in all_classes[category]:
-                scene_encoding += f"has_attr({oid1}, class, {sanitize_asp(category)}).\n"
+                scene_encoding.fact("has_attr", oid1, "class", sanitize_asp(category))
         
-        scene_encoding += f"has_attr({oid1}, name, {sanitize_asp(object1['name'])}).\n"
+        scene_encoding.fact("has_attr", oid1, "name", sanitize_asp(object1['name']))
 
         if (object1['x'] + object1['w']/2) > image_size["w"]/3*2:
-            scene_encoding += f"has_attr({oid1}, hposition, right).\n"
+            scene_encoding.fact("has_attr", oid1, "hposition", "right")
         elif (object1['x'] + object1['w']/2) > image_size["w"]/3:
-            scene_encoding += f"has_attr({oid1}, hposition, middle).\n"
+            scene_encoding.fact("has_attr", oid1, "hposition", "middle")
         else:
-            scene_encoding += f"has_attr({oid1}, hposition, left).\n"
+            scene_encoding.fact("has_attr", oid1, "hposition", "left")
 
         if (object1['y'] + object1['h']/2) > image_size["h"]/3*2:
-            scene_encoding += f"has_attr({oid1}, vposition, bottom).\n"
+            scene_encoding.fact("has_attr", oid1, "vposition", "bottom")
         elif (object1['y'] + object1['h']/2) > image_size["h"]/3:
-            scene_encoding += f"has_attr({oid1}, vposition, middle).\n"
+            scene_encoding.fact("has_attr", oid1, "vposition", "middle")
         else:
-            scene_encoding += f"has_attr({oid1}, vposition, top).\n"
-        scene_encoding += "\n"
-
-        neutral_indices = num_objects
-        if len(attributes) > 0:    
-            attr_scores = torch.stack([
-                obj_logits_per_image[o1, neutral_indices+o1*(num_attr_values):neutral_indices+(o1+1)*num_attr_values],
-                obj_logits_per_image[o1, o1].expand(num_attr_values)
-            ])
-            attr_probs = torch.nn.functional.softmax(attr_scores, dim=0)  
-
-            # print(f"{num_attr_values}, {attr_probs.shape}")
-
-            j = 0
-            for attr in attributes:
-                for val in all_attributes.get(attr, []): 
-                    scene_encoding += f"{{has_attr({oid1}, {cleanup_whitespace(attr)}, {cleanup_whitespace(val)})}}.\n"
-                    scene_encoding += f":~ has_attr({oid1}, {cleanup_whitespace(attr)}, {cleanup_whitespace(val)}). [{prob_to_asp_weight(attr_probs[0,j])}, ({oid1}, {cleanup_whitespace(attr)}, {cleanup_whitespace(val)})]\n"
-                    scene_encoding += f":~ not has_attr({oid1}, {cleanup_whitespace(attr)}, {cleanup_whitespace(val)}). [{prob_to_asp_weight(attr_probs[1,j])}, ({oid1}, {cleanup_whitespace(attr)}, {cleanup_whitespace(val)})]\n"
-                    j += 1
-                
-            scene_encoding += "\n"
-
-            del attr_scores, attr_probs
+            scene_encoding.fact("has_attr", oid1, "vposition", "top")
 
-        if len(standalone_values) > 0:
-            attr_indices = num_objects*num_attr_values
-            standalone_scores = torch.stack([
-                obj_logits_per_image[o1, (neutral_indices+attr_indices)+o1*num_standalone_values:(neutral_indices+attr_indices)+(o1+1)*num_standalone_values],
-                obj_logits_per_image[o1, o1].expand(num_standalone_values)
-            ])
-            standalone_probs = torch.nn.functional.softmax(standalone_scores, dim=0)
-
-            # print(f"{num_standalone_values}, {standalone_probs.shape}")
-
-            k = 0
-            for standalone_value_ in standalone_values:
-                scene_encoding += f"{{has_attr({oid1}, any, {cleanup_whitespace(standalone_value_)})}}.\n"
-                scene_encoding += f":~ has_attr({oid1}, any, {cleanup_whitespace(standalone_value_)}). [{prob_to_asp_weight(standalone_probs[0,k])}, ({oid1}, any, {cleanup_whitespace(standalone_value_)})]\n"
-                scene_encoding += f":~ not has_attr({oid1}, any, {cleanup_whitespace(standalone_value_)}). [{prob_to_asp_weight(standalone_probs[1,k])}, ({oid1}, any, {cleanup_whitespace(standalone_value_)})]\n"
-                k += 1
+        if len(attributes) > 0:
+            scene_encoding.soft_many("has_attr", [(oid1, attr, val) for attr, val in attr_atoms], attr_weights[0][o1], attr_weights[1][o1])
 
-            del standalone_scores, standalone_probs
+        if len(standalone_values) > 0:
+            scene_encoding.soft_many("has_attr", [(oid1, attr, val) for attr, val in standalone_atoms],
+                                     standalone_weights[0][o1], standalone_weights[1][o1])
 
-        # get cosine similarities between relations and every object pair's image crop
+        # relation weights of every object pair's image crop (see score_relations)
         if len(relations) > 0 and len(objects) > 1:
-            rel_prompts = []
-            for oid2, object2 in object_items:
-                if oid2 != oid1:
-                    for rel in relations:
-                        rel_prompts.append(f"{get_article(object1['name'])} {object1['name']} {rel} {get_article(object2['name'])} {object2['name']}")
-                    rel_prompts.append(f"{get_article(object1['name'])} {object1['name']} and {get_article(object2['name'])} {object2['name']}")
-
-            rel_logits_per_image = model.score(rel_bbox_crops, rel_prompts)
-            
-            m = 0
             for o2, (oid2, object2) in enumerate(object_items):
                 if oid1 != oid2:
-                    rel_scores = torch.stack([
-                        rel_logits_per_image[rel_bbox_indices[o1, o2], m*(num_relations+1):m*(num_relations+1)+num_relations],
-                        rel_logits_per_image[rel_bbox_indices[o1, o2], m*(num_relations+1)+num_relations].expand(num_relations)
-                    ])
-                    rel_probs = torch.nn.functional.softmax(rel_scores, dim=0)
-
-                    n = 0
-                    for rel in relations:
-                        scene_encoding += f"{{has_rel({oid1}, {cleanup_whitespace(rel)}, {oid2})}}.\n"
-                        scene_encoding += f":~ has_rel({oid1}, {cleanup_whitespace(rel)}, {oid2}). [{prob_to_asp_weight(rel_probs[0,n])}, ({oid1}, {cleanup_whitespace(rel)}, {oid2})]\n"
-                        scene_encoding += f":~ not has_rel({oid1}, {cleanup_whitespace(rel)}, {oid2}). [{prob_to_asp_weight(rel_probs[1,n])}, ({oid1}, {cleanup_whitespace(rel)}, {oid2})]\n"
-
-                        n += 1
-                    
-                    scene_encoding += "\n"
-                    m += 1
-
-                    del rel_scores, rel_probs
-                
-            del rel_logits_per_image
-
-    try: 
-        del obj_logits_per_image
-    except:
-        pass
-
-    return scene_encoding
+                    scene_encoding.soft_many("has_rel", [(oid1, rel, oid2) for rel in rel_names], rel_weights[0][o1][o2], rel_weights[1][o1][o2])
+
+    return scene_encoding.to_asp() if as_text else scene_encoding
@@ -0,0 +1,110 @@
+from clingo.symbol import Function, Number
+import hashlib
+
+
+def to_symbol(arg):
+    if isinstance(arg, int):
+        return Number(arg)
+    if arg.lstrip("-").isdigit():
+        return Number(int(arg))
+    return Function(arg)
+
+
+class SceneProgram:
+    """Scene encoding kept as facts and uncertain (soft) atoms instead of ASP text.
+
+    The program is written straight into the clingo backend by ClingoSession, so no
+    program string has to be built and parsed again. to_asp renders the equivalent
+    ASP text and is only meant for debugging.
+    """
+
+    def __init__(self):
+        # ("fact", predicate, args) or ("soft", predicate, args, weight_true, weight_false)
+        self.statements = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def __str__(self):
+        return self.to_asp()
+
+    def fact(self, predicate, *args):
+        self.statements.append(("fact", predicate, args))
+
+    def soft(self, predicate, args, weight_true, weight_false):
+        """Adds a choice over predicate(args) with the weights paid if the atom is true or false."""
+        self.statements.append(("soft", predicate, tuple(args), weight_true, weight_false))
+
+    def soft_many(self, predicate, args_list, weights_true, weights_false):
+        """Adds soft(predicate, args, weight_true, weight_false) for the args and weights at the same positions."""
+        self.statements.extend(("soft", predicate, tuple(args), weight_true, weight_false)
+                               for args, weight_true, weight_false in zip(args_list, weights_true, weights_false))
+
+    def digest(self):
+        """Content hash of the program, e.g. for caching solver results."""
+        return hashlib.sha256(repr(self.statements).encode()).hexdigest()
+
+    def iter_asp(self, soft_encoding="pair"):
+        """Yields the ASP text of the program statement by statement, see add_to_control for soft_encoding."""
+        offset = 0
+        for statement in self.statements:
+            predicate, args = statement[1], ", ".join(map(str, statement[2]))
+            if statement[0] == "fact":
+                yield f"{predicate}({args}).\n"
+            else:
+                weight_true, weight_false = statement[3], statement[4]
+                if soft_encoding == "pair":
+                    yield (f"{{{predicate}({args})}}.\n"
+                           f":~ {predicate}({args}). [{weight_true}, ({args})]\n"
+                           f":~ not {predicate}({args}). [{weight_false}, ({args})]\n")
+                else:
+                    yield f"{{{predicate}({args})}}.\n"
+                    if weight_true != weight_false:
+                        yield f":~ {predicate}({args}). [{weight_true - weight_false}, ({args})]\n"
+                    offset += weight_false
+
+        if offset != 0:
+            yield f":~ #true. [{offset}, soft_offset]\n"
+
+    def write_asp(self, sink, soft_encoding="pair", chunk_size=1 << 16):
+        """Writes the ASP text to a file-like sink in chunks of about chunk_size characters."""
+        chunk, size = [], 0
+        for text in self.iter_asp(soft_encoding):
+            chunk.append(text)
+            size += len(text)
+            if size >= chunk_size:
+                sink.write("".join(chunk))
+                chunk, size = [], 0
+        sink.write("".join(chunk))
+
+    def to_asp(self, soft_encoding="pair"):
+        return "".join(self.iter_asp(soft_encoding))
+
+    def add_to_control(self, ctl, soft_encoding="pair"):
+        """Adds the program through the backend of ctl.
+
+        soft_encoding "pair" adds one weighted literal for the true and one for the false case of each
+        soft atom. "compact" only weights the true case with the difference of both weights (the log-odds
+        of the atom) and pays the sum of the false weights as a constant, so the costs of all models stay
+        the same with half the weighted literals.
+        """
+        offset = 0
+        with ctl.backend() as backend:
+            for statement in self.statements:
+                atom = Function(statement[1], [to_symbol(arg) for arg in statement[2]])
+                literal = backend.add_atom(atom)
+                if statement[0] == "fact":
+                    backend.add_rule([literal])
+                elif soft_encoding == "pair":
+                    backend.add_rule([literal], choice=True)
+                    backend.add_minimize(0, [(literal, statement[3]), (-literal, statement[4])])
+                else:
+                    backend.add_rule([literal], choice=True)
+                    if statement[3] != statement[4]:
+                        backend.add_minimize(0, [(literal, statement[3] - statement[4])])
+                    offset += statement[4]
+
+            if offset != 0:
+                true_literal = backend.add_atom()
+                backend.add_rule([true_literal])
+                backend.add_minimize(0, [(true_literal, offset)])
@@ -0,0 +1,74 @@
+from constants import CACHE_PATH
+import hashlib
+import sqlite3
+import json
+import zlib
+import time
+import os
+
+
+def content_key(*parts):
+    """Stable hash over json serializable parts."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class SolverCache:
+    """Content-addressed on-disk store for solver results.
+
+    Results are stored compressed in a sqlite file. Once the stored results exceed max_bytes the
+    least recently used ones are evicted. The total size is read when the cache is opened and then kept
+    up to date by this instance, results written by other processes are counted once it is reopened.
+    hits and misses count the lookups of this instance.
+    """
+
+    def __init__(self, path=os.path.join(CACHE_PATH, "solver_cache.sqlite"), max_bytes=256 * 1024**2):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self.connection.commit()
+        self.total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def get(self, key):
+        row = self.connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.connection.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+        self.connection.commit()
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, result):
+        value = zlib.compress(json.dumps(result).encode())
+        replaced = self.connection.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+        self.total_size += len(value) - (replaced[0] if replaced is not None else 0)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+            (key, value, len(value), time.time())
+        )
+        self.evict()
+        self.connection.commit()
+
+    def evict(self, batch_size=256):
+        while self.total_size > self.max_bytes:
+            # the least recently used results, read in batches instead of scanning the whole table
+            oldest = self.connection.execute("SELECT key, size FROM results ORDER BY accessed LIMIT ?", (batch_size,)).fetchall()
+            if len(oldest) == 0:
+                self.total_size = 0
+                return
+            for key, size in oldest:
+                self.connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.total_size -= size
+                if self.total_size <= self.max_bytes:
+                    return
+
+    def close(self):
+        self.connection.close()
@@ -7,6 +7,7 @@ DATAPATH = os.path.join("/home/bileam", "data")
 GQA_DATAPATH = os.path.join(DATAPATH, "gqa")
 VISUAL_GENOME_DATAPATH = os.path.join(DATAPATH, "visual_genome")
 CACHE_PATH = os.path.join(DATAPATH, "cache")
+INFERENCE_SOCKET = os.path.join(CACHE_PATH, "inference.sock")
 
 def read_concepts():
     with open(os.path.join(GQA_DATAPATH, "metadata", 'gqa_all_class.json')) as f:
@@ -6,22 +6,38 @@ from tqdm import tqdm
 from utils import answer_is_correct, question_iterator, code_to_flat, nested_to_flat
 from evaluation import CSVLogger
 from prompt_tools import LLMConfig
-from gs_vqa.model.clip_model import CLIPModel
-from gs_vqa.object_detection.owl_vit_object_detector import OWLViTObjectDetector
+from gs_vqa.inference_server import InferenceClient, RemoteConceptModel, RemoteObjectDetector
+from gs_vqa.model.pipeline_models import load_pipeline_models
+from gs_vqa.object_detection.detection_index import DetectionIndex
+from gs_vqa.image_loader import ImageLoader
 from semantic_interpreter import GQAObject, FakeGQAObject
 
 
-from asp_encoding import encode_question, run_clingo, encode_scene
+from asp_encoding import encode_question, encode_scene, ClingoSession, SolverCache
 from llms import OpenAILLM
 
 if torch.cuda.is_available():
     device = torch.device("cuda")
 else:
     device = torch.device("cpu")
+# fp32, int8, bf16 or compile, see gs_vqa.model.inference_mode and python -m evaluation.benchmarks inference_modes
+INFERENCE_MODE = "fp32"
+# use the models hosted by python -m gs_vqa.inference_server instead of loading them in every process
+USE_INFERENCE_SERVER = False
+
+if USE_INFERENCE_SERVER:
+    inference_client = InferenceClient()
+    concept_model = RemoteConceptModel(inference_client)
+    object_detector = RemoteObjectDetector(inference_client)
+else:
+    concept_model, object_detector = load_pipeline_models(device, INFERENCE_MODE)
+# filled by python -m gs_vqa.object_detection.detection_index, images missing in it are detected as usual
+detection_index = DetectionIndex()
+if detection_index.model_id is not None and not detection_index.matches(object_detector):
+    print(f"detection index of {detection_index.model_id} (format {detection_index.format}) is not used with {object_detector.model_id}")
+image_loader = ImageLoader()
 
-concept_model = CLIPModel(device, model="openai/clip-vit-base-patch32")
-
-object_detector = OWLViTObjectDetector(device, usev2=True)
+clingo_session = ClingoSession(timeout=10.0, slice_scene=True, cache=SolverCache())
 
 def count_operators(question):
     operations = ["select", "query", "filter", "relate", "verify", "choose", "exist", "or", "different", "and", "same", "common"]
@@ -31,6 +47,10 @@ def count_operators(question):
         op_counts[f"op_{operator}"] += 1
     return op_counts
 
+def solve_topk(scene_encoding, question_encoding):
+    solved = clingo_session.solve_topk(scene_encoding, question_encoding, topk=TOPK, statistics=True)
+    return solved["answers"], solved["statistics"]
+
 def is_scene_question(question):
     return question["semantic"][0]["operation"] == "select" and question["semantic"][0]["argument"] == "scene"
 
@@ -49,10 +69,13 @@ def evaluate_question(question):
     else:
         result["skipped"] = False
 
-        scene_encoding = encode_scene(question, concept_model, object_detector)
+        scene_encoding = encode_scene(question, concept_model, object_detector, detection_index=detection_index, image_loader=image_loader)
         question_encoding = encode_question(question)
-        answer = run_clingo(scene_encoding, question_encoding)
-
+        solved = clingo_session.solve(scene_encoding, question_encoding, statistics=True)
+        answer = solved["answers"]
+        result["timeout"] = solved["timeout"]
+        result["runtime_sec"] = solved["runtime_sec"]
+        result.update(solved["statistics"])
 
         if len(answer) > 0:
             return {**result, "model_response": answer, "correct": answer_is_correct(answer, question["answer"])}
@@ -76,12 +99,12 @@ llm_model = OpenAILLM(version=LLM_MODEL, config=config)
 if __name__ == "__main__":
     logger = CSVLogger(os.path.abspath(os.path.join(__file__, "..", "..", "logs", "test_forced_eval.csv")))
     models = [LLM_MODEL]
-    for scene_graph, qid, question in tqdm(question_iterator(500, target_set="testdev"), total=500):
+    for scene_graph, qid, question in tqdm(image_loader.prefetch(question_iterator(500, target_set="testdev")), total=500):
         if logger.is_answered(qid, "pipeline_base"):
             continue
-        scene_encoding = encode_scene(question, concept_model, object_detector)
-        gt_answer = run_clingo(scene_encoding, encode_question(question), topk=TOPK)
-        logger.log_safe(qid, "pipeline_base", gt_answer, config=None)
+        scene_encoding = encode_scene(question, concept_model, object_detector, detection_index=detection_index, image_loader=image_loader)
+        gt_answer, gt_statistics = solve_topk(scene_encoding, encode_question(question))
+        logger.log_safe(qid, "pipeline_base", gt_answer, config=None, statistics=gt_statistics)
         logger.log_safe(qid, "answer", question["answer"], config=None)
         for model in models:
             full_name = f"pipeline_{model}"
@@ -92,8 +115,8 @@ if __name__ == "__main__":
                     )
                     logger.log(qid, llm_model.name, llm_output, n_actual_examples, raw=True, config=llm_model.config)
                 pred_question_enc = translators[config.target_repr](logger.get_answer(qid, model+"_raw").values[0])
-                pred_answer = run_clingo(scene_encoding, pred_question_enc, topk=TOPK)
-                logger.log_safe(qid, full_name, pred_answer, config=config)
+                pred_answer, pred_statistics = solve_topk(scene_encoding, pred_question_enc)
+                logger.log_safe(qid, full_name, pred_answer, config=config, statistics=pred_statistics)
             except Exception as e:
                 print(e)
                 logger.log_safe(qid, full_name, "error", config=config)
@@ -103,12 +126,17 @@ if __name__ == "__main__":
                 try:
                     pred_question_enc = translators[config.target_repr](logger.get_answer(qid, model+"_raw").values[0])
                     
-                    pred_answer = run_clingo(encode_scene(question, concept_model, object_detector, blind=True, question_enc=pred_question_enc), pred_question_enc, topk=TOPK)
-                    logger.log_safe(qid, full_name+"_blind", pred_answer, config=config)
+                    pred_answer, pred_statistics = solve_topk(encode_scene(question, concept_model, object_detector, blind=True, question_enc=pred_question_enc, detection_index=detection_index, image_loader=image_loader), pred_question_enc)
+                    logger.log_safe(qid, full_name+"_blind", pred_answer, config=config, statistics=pred_statistics)
                 except Exception as e:
                     print(e)
                     logger.log_safe(qid, full_name+"_blind", "error", config=config)
         logger.save()
+    print(f"solver cache: {clingo_session.cache.hits} hits, {clingo_session.cache.misses} misses")
+    if not USE_INFERENCE_SERVER:
+        print(f"text feature cache: {concept_model.text_cache.hits} hits, {concept_model.text_cache.misses} misses")
+    print(f"crop feature cache: {concept_model.image_cache.hits} hits, {concept_model.image_cache.misses} misses")
+    print(f"image loader: {image_loader.hits} hits, {image_loader.misses} misses, {image_loader.wait_sec:.1f}s waiting for decoding")
     logger.score(categories=[], topk=1, use_wordnet=False)
 
             
@@ -0,0 +1,439 @@
+import io
+import time
+import inspect
+import argparse
+import random
+import tempfile
+import tracemalloc
+import pandas as pd
+
+from asp_encoding import ClingoSession, SOLVER_PROFILES
+from asp_encoding.scene_program import SceneProgram
+from asp_encoding.scene_encoding import prob_to_asp_weight
+from gs_vqa.pipeline.bounding_box_optimization import get_pair_bboxes
+
+BENCHMARK_CLASSES = ["car", "bus", "dog", "table", "chair", "man", "tree", "building"]
+BENCHMARK_ATTRIBUTES = {"color": ["red", "blue", "white", "black", "green"], "material": ["wood", "metal", "plastic"]}
+BENCHMARK_RELATIONS = ["to_the_left_of", "to_the_right_of", "on", "near"]
+
+BENCHMARK_QUESTIONS = {
+    "query": "scene(0).\nselect(1, 0, car).\nunique(2, 1).\nquery(3, 2, color).\nend(3).",
+    "verify_rel": "scene(0).\nselect(1, 0, car).\nunique(2, 1).\nverify_rel(3, 2, table, on, object).\nend(3).",
+    "choose_rel": "scene(0).\nselect(1, 0, dog).\nunique(2, 1).\nchoose_rel(3, 2, tree, to_the_left_of, to_the_right_of, subject).\nend(3).",
+    "relate_attr": "scene(0).\nselect(1, 0, man).\nrelate_attr(2, 1, car, color).\nexist(3, 2).\nend(3).",
+    "common": "scene(0).\nselect(1, 0, chair).\nscene(2).\nselect(3, 2, table).\nunique(4, 1).\nunique(5, 3).\ncommon(6, 4, 5).\nend(6).",
+}
+
+
+def random_scene_program(n_objects, seed=0):
+    """Scene with n_objects detections and soft attributes and relations of random confidence."""
+    rnd = random.Random(seed)
+    program = SceneProgram()
+    for attr, values in BENCHMARK_ATTRIBUTES.items():
+        program.fact("is_attr", attr)
+        for val in values:
+            program.fact("is_attr_value", attr, val)
+
+    for i in range(n_objects):
+        clazz = BENCHMARK_CLASSES[i % len(BENCHMARK_CLASSES)]
+        program.fact("object", f"o{i}")
+        program.fact("has_obj_weight", f"o{i}", prob_to_asp_weight(rnd.uniform(0.05, 0.95)))
+        program.fact("has_attr", f"o{i}", "class", clazz)
+        program.fact("has_attr", f"o{i}", "name", clazz)
+        for attr, values in BENCHMARK_ATTRIBUTES.items():
+            for val in values:
+                prob = rnd.uniform(0.01, 0.99)
+                program.soft("has_attr", (f"o{i}", attr, val), prob_to_asp_weight(prob), prob_to_asp_weight(1 - prob))
+
+    for i in range(n_objects):
+        for j in range(n_objects):
+            if i != j:
+                for rel in BENCHMARK_RELATIONS:
+                    prob = rnd.uniform(0.01, 0.99)
+                    program.soft("has_rel", (f"o{i}", rel, f"o{j}"), prob_to_asp_weight(prob), prob_to_asp_weight(1 - prob))
+    return program
+
+
+def benchmark_soft_encoding(object_counts=(5, 10, 20), seeds=3, topk=3):
+    """Compares the pair and the compact encoding of soft atoms on random scenes.
+
+    Both encodings have to yield the same answers with the same costs (checked for all solves that
+    finished within the timeout). Reports the ground program size and the solve time of each encoding.
+    """
+    sessions = {encoding: ClingoSession(soft_encoding=encoding) for encoding in ["pair", "compact"]}
+    rows = []
+    mismatches = []
+    for n_objects in object_counts:
+        for seed in range(seeds):
+            scene = random_scene_program(n_objects, seed)
+            for question_type, question_encoding in BENCHMARK_QUESTIONS.items():
+                results = {}
+                for encoding, session in sessions.items():
+                    results[encoding] = session.solve_topk(scene, question_encoding, topk=topk, statistics=True)
+                    rows.append({"encoding": encoding, "objects": n_objects, "question": question_type,
+                                 **results[encoding]["statistics"]})
+
+                pair, compact = results["pair"], results["compact"]
+                if pair["status"] != "ok" or compact["status"] != "ok":
+                    # interrupted optimizations are not comparable
+                    continue
+                if pair["costs"] != compact["costs"] or set(pair["answers"]) != set(compact["answers"]):
+                    mismatches.append((n_objects, seed, question_type, pair["answers"], compact["answers"]))
+
+    if len(mismatches) > 0:
+        raise AssertionError(f"encodings disagree: {mismatches}")
+
+    return pd.DataFrame(rows).groupby(["objects", "encoding"])[["atoms", "rules", "weak_constraints", "ground_sec", "solve_sec"]].mean()
+
+
+def question_type(question_encoding):
+    """Operation of the last step before end, e.g. query or verify_rel."""
+    operations = [line.split("(")[0].strip() for line in question_encoding.split(").") if "(" in line]
+    operations = [op for op in operations if op != "end"]
+    return operations[-1] if len(operations) > 0 else "unknown"
+
+
+def logged_problems(log_path, n_questions=50, target_set="testdev", agent="pipeline_base", perfect=False):
+    """(question type, scene encoding, question encoding) of the questions answered by agent in a CSVLogger log.
+
+    Scenes are encoded from the image with the detection models of the pipeline, or from the ground truth
+    scene graph if perfect is set.
+    """
+    from evaluation import CSVLogger
+    from utils import question_iterator
+    from asp_encoding import encode_question, encode_scene, encode_scene_perfect
+
+    logger = CSVLogger(log_path)
+    qids = set(logger.records[logger.records["agent"] == agent]["qid"].head(n_questions))
+    if not perfect:
+        import torch
+        from gs_vqa.model.clip_model import CLIPModel
+        from gs_vqa.object_detection.owl_vit_object_detector import OWLViTObjectDetector
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        concept_model = CLIPModel(device, model="openai/clip-vit-base-patch32")
+        object_detector = OWLViTObjectDetector(device, usev2=True)
+
+    problems = []
+    # n_questions=-1 iterates the whole set
+    for scene_graph, qid, question in question_iterator(-1, target_set=target_set):
+        if qid not in qids:
+            continue
+        question_encoding = encode_question(question)
+        if perfect:
+            scene_encoding = encode_scene_perfect(scene_graph)
+        else:
+            scene_encoding = encode_scene(question, concept_model, object_detector)
+        problems.append((question_type(question_encoding), scene_encoding, question_encoding))
+        if len(problems) == len(qids):
+            break
+    return problems
+
+
+def random_problems(object_counts=(5, 10), seeds=2):
+    return [(question_type(question_encoding), random_scene_program(n_objects, seed), question_encoding)
+            for n_objects in object_counts for seed in range(seeds) for question_encoding in BENCHMARK_QUESTIONS.values()]
+
+
+def benchmark_solver_profiles(log_path=None, n_questions=50, profiles=None, reference="default", topk=5, timeout=10.0,
+                              soft_encoding="pair"):
+    """Replays questions under each solver profile and reports latency percentiles and answer agreement per question type.
+
+    Questions are taken from a CSVLogger log if log_path is given (see logged_problems), otherwise random scenes
+    are used. Each question is solved with solve_topk as in the pipeline. agreement is the share of questions
+    whose optimal answers (see optimal_answers) equal those of the reference profile, so profiles that only order
+    answers of equal cost differently still agree. timeouts is the share of interrupted solves. The fastest
+    profile per question type with full agreement is printed by the benchmark command.
+    """
+    problems = random_problems() if log_path is None else logged_problems(log_path, n_questions)
+    profiles = list(SOLVER_PROFILES) if profiles is None else profiles
+    session = ClingoSession(timeout=timeout, slice_scene=True, soft_encoding=soft_encoding)
+
+    rows = []
+    for i, (qtype, scene_encoding, question_encoding) in enumerate(problems):
+        results = {profile: session.solve_topk(scene_encoding, question_encoding, topk=topk, profile=profile)
+                   for profile in profiles}
+        for profile, result in results.items():
+            rows.append({"question": i, "question_type": qtype, "profile": profile, "runtime_sec": result["runtime_sec"],
+                         "timeout": result["timeout"], "agrees": optimal_answers(result) == optimal_answers(results[reference])})
+
+    runs = pd.DataFrame(rows)
+    return runs.groupby(["question_type", "profile"]).agg(
+        n=("question", "count"),
+        p50_sec=("runtime_sec", lambda x: x.quantile(0.5)),
+        p90_sec=("runtime_sec", lambda x: x.quantile(0.9)),
+        p99_sec=("runtime_sec", lambda x: x.quantile(0.99)),
+        timeouts=("timeout", "mean"),
+        agreement=("agrees", "mean"),
+    )
+
+
+def optimal_answers(result):
+    """Cost of the best model and the set of answers with that cost in a solve_topk result."""
+    if len(result["answers"]) == 0:
+        return None, frozenset()
+    best = result["costs"][0]
+    return best, frozenset(answer for answer, cost in zip(result["answers"], result["costs"]) if cost == best)
+
+
+def best_profiles(report, min_agreement=1.0, latency="p90_sec"):
+    """Fastest profile per question type among the profiles that agree with the reference often enough."""
+    candidates = report[report["agreement"] >= min_agreement].reset_index()
+    fastest = candidates.loc[candidates.groupby("question_type")[latency].idxmin()]
+    return dict(zip(fastest["question_type"], fastest["profile"]))
+
+
+def random_objects(n_objects, seed=0, image_size=(640, 480)):
+    """Detections with random boxes, many of them overlapping as detections of several queries of a question do."""
+    rnd = random.Random(seed)
+    objects = []
+    for _ in range(n_objects):
+        w, h = rnd.uniform(10, image_size[0] / 2), rnd.uniform(10, image_size[1] / 2)
+        objects.append({"x": rnd.uniform(0, image_size[0] - w), "y": rnd.uniform(0, image_size[1] - h), "w": w, "h": h})
+    return objects
+
+
+def benchmark_pair_bboxes(object_counts=(5, 10, 20, 40, 60), seeds=3, merge_threshold=0.7):
+    """Compares the loop and the vectorized construction and merging of the relation boxes in get_pair_bboxes.
+
+    Both have to give the same boxes and bbox_indices. Reports the number of object pairs, the number of boxes
+    left after merging and the runtime of both implementations.
+    """
+    rows = []
+    for n_objects in object_counts:
+        for seed in range(seeds):
+            objects = random_objects(n_objects, seed)
+            results = {}
+            for vectorized in [False, True]:
+                start = time.perf_counter()
+                results[vectorized] = get_pair_bboxes(objects, merge_threshold=merge_threshold, vectorized=vectorized)
+                rows.append({"objects": n_objects, "vectorized": vectorized, "pairs": n_objects * (n_objects - 1) // 2,
+                             "boxes": len(results[vectorized][0]), "sec": time.perf_counter() - start})
+
+            (loop_boxes, loop_indices), (boxes, indices) = results[False], results[True]
+            if [tuple(map(float, box)) for box in loop_boxes] != boxes or (loop_indices != indices).any():
+                raise AssertionError(f"get_pair_bboxes implementations disagree for {n_objects} objects, seed {seed}")
+
+    return pd.DataFrame(rows).groupby(["objects", "vectorized"])[["pairs", "boxes", "sec"]].mean()
+
+
+def soft_atom_log_odds(scene_encoding):
+    """weight_true - weight_false of every soft atom of a SceneProgram, by (predicate, args)."""
+    return {(s[1], s[2]): s[3] - s[4] for s in scene_encoding.statements if s[0] == "soft"}
+
+
+def benchmark_inference_modes(n_questions=20, target_set="testdev", modes=None, clip_model="openai/clip-vit-base-patch32", device="cpu"):
+    """Compares the scores of the concept model and the detector in each inference mode with fp32 on GQA questions.
+
+    Attribute and relation atoms are compared on scenes encoded with the concept model in each mode from the
+    objects of the fp32 detector, so all scenes of a question have the same objects. The detections of each mode
+    are matched to the fp32 detections by name and an IoU above 0.9. Reports per score kind and mode the mean and
+    maximum difference of the ASP weights (weight_true - weight_false for soft atoms, has_obj_weight for
+    detections), the agreement with fp32 (share of soft atoms whose more likely truth value is the same, recall of
+    the fp32 detections) and the mean runtime of scoring the attributes of a scene, its relations or detecting its objects.
+    """
+    import torch
+    from torchvision.ops import box_iou
+    from utils import question_iterator
+    from asp_encoding import encode_scene
+    from asp_encoding.scene_encoding import detect_objects_question_driven, extract_classes
+    from gs_vqa.image_loader import load_image
+    from gs_vqa.model.clip_model import CLIPModel
+    from gs_vqa.model.inference_mode import INFERENCE_MODES
+    from gs_vqa.object_detection.owl_vit_object_detector import OWLViTObjectDetector
+    from gs_vqa.pipeline.detection_merging import object_boxes
+
+    device = torch.device(device)
+    modes = ["fp32", *[mode for mode in (INFERENCE_MODES if modes is None else modes) if mode != "fp32"]]
+    questions = [question for _, _, question in question_iterator(n_questions, target_set=target_set)]
+    reference_detector = OWLViTObjectDetector(device, usev2=True)
+
+    reference_scenes, reference_objects = {}, {}
+    rows = []
+    runtimes = []
+    for mode in modes:
+        concept_model = CLIPModel(device, model=clip_model, inference_mode=mode)
+        object_detector = reference_detector if mode == "fp32" else OWLViTObjectDetector(device, usev2=True, inference_mode=mode)
+        for question in questions:
+            qid = question["qid"]
+            image = load_image(question["imageId"])
+
+            start = time.perf_counter()
+            objects = detect_objects_question_driven(image, extract_classes(question), object_detector)
+            detect_sec = time.perf_counter() - start
+            if mode == "fp32":
+                reference_objects[qid] = objects
+            timings = {}
+            scene = soft_atom_log_odds(encode_scene(question, concept_model, reference_detector, objects=reference_objects[qid], timings=timings))
+            if mode == "fp32":
+                reference_scenes[qid] = scene
+            runtimes.append({"kind": "detection", "mode": mode, "runtime_sec": detect_sec})
+            runtimes.extend({"kind": kind, "mode": mode, "runtime_sec": timings[f"{kind}_sec"]}
+                            for kind in ["attribute", "relation"] if f"{kind}_sec" in timings)
+
+            for kind, predicate in [("attribute", "has_attr"), ("relation", "has_rel")]:
+                diffs = [(abs(log_odds - reference_scenes[qid][atom]), (log_odds > 0) == (reference_scenes[qid][atom] > 0))
+                         for atom, log_odds in scene.items() if atom[0] == predicate]
+                rows.extend({"kind": kind, "mode": mode, "weight_diff": diff, "agrees": agrees} for diff, agrees in diffs)
+
+            reference = reference_objects[qid]
+            if len(reference) == 0:
+                continue
+            matches = torch.zeros((len(reference), max(len(objects), 1)), dtype=torch.bool)
+            if len(objects) > 0:
+                same_name = torch.tensor([[o["name"] == r["name"] for o in objects] for r in reference])
+                matches = same_name & (box_iou(object_boxes(reference), object_boxes(objects)) > 0.9)
+            for r, ref_object in enumerate(reference):
+                matched = matches[r].nonzero()[:, 0].tolist()
+                diff = abs(prob_to_asp_weight(objects[matched[0]]["score"]) - prob_to_asp_weight(ref_object["score"])) if matched else None
+                rows.append({"kind": "detection", "mode": mode, "weight_diff": diff, "agrees": len(matched) > 0})
+
+    report = pd.DataFrame(rows).groupby(["kind", "mode"]).agg(
+        n=("agrees", "count"),
+        weight_diff_mean=("weight_diff", "mean"),
+        weight_diff_max=("weight_diff", "max"),
+        agreement=("agrees", "mean"),
+    )
+    return report.join(pd.DataFrame(runtimes).groupby(["kind", "mode"])["runtime_sec"].mean())
+
+
+def benchmark_batching(n_requests=64, concurrency=8, crops=(5, 30), max_batch_sizes=(32, 64, 128), max_wait_ms=(2.0, 5.0, 10.0),
+                       clip_model="openai/clip-vit-base-patch32", device="cpu"):
+    """Throughput of the crop features of concurrent questions, computed directly or through a BatchingModel.
+
+    concurrency threads send n_requests get_pixel_features requests with a random number of crops each, as
+    crop_features does for the objects of a question. Direct requests run one at a time, as on an InferenceServer
+    without batching. The batched features have to match the direct ones. Reports the crops per second of wall
+    time, the request latency percentiles and the mean number of crops per model call.
+    """
+    import torch
+    import numpy as np
+    from threading import Lock
+    from concurrent.futures import ThreadPoolExecutor
+    from gs_vqa.model.clip_model import CLIPModel
+    from gs_vqa.model.batching_model import BatchingModel
+
+    concept_model = CLIPModel(torch.device(device), model=clip_model)
+    rnd = random.Random(0)
+    sizes = [rnd.randint(*crops) for _ in range(n_requests)]
+    pixel_values = torch.randn((crops[1], 3, concept_model.img_size, concept_model.img_size), generator=torch.Generator().manual_seed(0))
+
+    lock = Lock()
+    def direct(pixel_values):
+        with lock, torch.no_grad():
+            return concept_model.get_pixel_features(pixel_values)
+
+    rows = []
+    reference = None
+    for max_batch_size, wait_ms in [(None, None), *[(size, wait) for size in max_batch_sizes for wait in max_wait_ms]]:
+        batching_model = None if max_batch_size is None else BatchingModel(concept_model, max_batch_size, wait_ms)
+        get_pixel_features = direct if batching_model is None else batching_model.get_pixel_features
+        latencies = []
+        def request(size):
+            start = time.perf_counter()
+            features = get_pixel_features(pixel_values[:size])
+            latencies.append(time.perf_counter() - start)
+            return features
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            features = list(pool.map(request, sizes))
+        wall_sec = time.perf_counter() - start
+
+        if batching_model is None:
+            reference = features
+        else:
+            batching_model.close()
+            if not all(torch.allclose(f, r, rtol=1e-3, atol=1e-4) for f, r in zip(features, reference)):
+                raise AssertionError(f"batched features differ for max_batch_size {max_batch_size}, max_wait_ms {wait_ms}")
+
+        rows.append({"batching": batching_model is not None, "max_batch_size": max_batch_size, "max_wait_ms": wait_ms,
+                     "crops_per_sec": sum(sizes) / wall_sec,
+                     "p50_latency_ms": 1000 * np.quantile(latencies, 0.5), "p90_latency_ms": 1000 * np.quantile(latencies, 0.9),
+                     "mean_batch_size": np.mean(sizes) if batching_model is None else batching_model.metrics()["mean_batch_size"]})
+    return pd.DataFrame(rows)
+
+
+def concat_asp(program, soft_encoding="pair"):
+    """ASP text of a SceneProgram appended statement by statement to one string, as scene encodings were built before."""
+    asp = ""
+    for text in program.iter_asp(soft_encoding):
+        asp += text
+    return asp
+
+
+def benchmark_asp_writer(object_counts=(30, 45, 60), seeds=2, soft_encoding="pair"):
+    """Compares building the ASP text of large scenes (n objects with n*(n-1)*4 soft relations) as one string with
+    streaming it chunk by chunk into an in-memory or a file sink.
+
+    All writers have to produce the same text. Reports the build time and the peak memory allocated while building
+    (tracemalloc, measured in a second run).
+    """
+    def write_asp(program, sink):
+        program.write_asp(sink, soft_encoding=soft_encoding)
+        return sink
+
+    writers = {
+        "concat": lambda program: concat_asp(program, soft_encoding),
+        "to_asp": lambda program: program.to_asp(soft_encoding),
+        "write_asp_buffer": lambda program: write_asp(program, io.StringIO()),
+        "write_asp_file": lambda program: write_asp(program, tempfile.TemporaryFile("w+")),
+    }
+
+    def text(result):
+        if isinstance(result, str):
+            return result
+        result.seek(0)
+        return result.read()
+
+    rows = []
+    for n_objects in object_counts:
+        for seed in range(seeds):
+            program = random_scene_program(n_objects, seed)
+            reference = program.to_asp(soft_encoding)
+            for writer, build in writers.items():
+                start = time.perf_counter()
+                result = build(program)
+                build_sec = time.perf_counter() - start
+                if text(result) != reference:
+                    raise AssertionError(f"{writer} differs from to_asp for {n_objects} objects, seed {seed}")
+                del result
+
+                tracemalloc.start()
+                result = build(program)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                del result
+                rows.append({"objects": n_objects, "writer": writer, "statements": len(program), "chars": len(reference),
+                             "build_sec": build_sec, "peak_mb": peak / 2**20})
+
+    return pd.DataFrame(rows).groupby(["objects", "writer"])[["statements", "chars", "build_sec", "peak_mb"]].mean()
+
+
+BENCHMARKS = {
+    "soft_encoding": benchmark_soft_encoding,
+    "solver_profiles": benchmark_solver_profiles,
+    "pair_bboxes": benchmark_pair_bboxes,
+    "inference_modes": benchmark_inference_modes,
+    "batching": benchmark_batching,
+    "asp_writer": benchmark_asp_writer,
+}
+
+if __name__ == "__main__":
+    # python -m evaluation.benchmarks [names] [--log-path logs/log.csv] [--n-questions 50]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run, all if none is given: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--log-path", help="replay the questions of a CSVLogger log (solver_profiles)")
+    parser.add_argument("--n-questions", type=int, help="number of questions taken from the log or data set")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+    options = {"log_path": args.log_path, "n_questions": args.n_questions}
+
+    for name in args.names or BENCHMARKS.keys():
+        print(f"------ {name} ------")
+        parameters = inspect.signature(BENCHMARKS[name]).parameters
+        report = BENCHMARKS[name](**{key: value for key, value in options.items() if value is not None and key in parameters})
+        print(report)
+        if name == "solver_profiles":
+            print(best_profiles(report))
@@ -8,6 +8,9 @@ from prompt_tools import LLMConfig
 
 
 class CSVLogger:
+    # solver statistics as returned by run_clingo(..., statistics=True)
+    statistics_columns = ["atoms", "rules", "weak_constraints", "choices", "conflicts", "ground_sec", "solve_sec"]
+
     def __init__(self, file_path):
         # https://pandas.pydata.org/pandas-docs/stable/user_guide/indexing.html
         pd.options.mode.copy_on_write = True
@@ -17,19 +20,24 @@ class CSVLogger:
             self.records = pd.read_csv(file_path, dtype={"qid": str, "answer": str})
         else:
             self.records = pd.DataFrame(columns=["qid", "agent", "answer", *LLMConfig.ablation_categories(), "nr_actual_examples"])
-        self.numeric_columns = ["nr_actual_examples", "n_similar_examples"]
+        for col in self.statistics_columns:
+            # logs written before the statistics were recorded
+            if col not in self.records.columns:
+                self.records[col] = None
+        self.numeric_columns = ["nr_actual_examples", "n_similar_examples", *self.statistics_columns]
         for col in self.numeric_columns:
             self.records[col] = pd.to_numeric(self.records[col], errors="coerce")
 
-    def log(self, qid, agent, answer, n_actual_examples=None, raw=False, config: LLMConfig = None):
+    def log(self, qid, agent, answer, n_actual_examples=None, raw=False, config: LLMConfig = None, statistics: dict = None):
         agent = f"{agent}_raw" if raw else agent
         n_actual_examples = n_actual_examples if n_actual_examples is not None else "-"
         ablation_values = config.get_ablation_values() if config is not None else ["-"]*len(LLMConfig.ablation_categories())
-        self.records.loc[len(self.records.index)] = [str(qid), agent, answer, *ablation_values, n_actual_examples]
+        statistics_values = [statistics.get(col) for col in self.statistics_columns] if statistics is not None else [None]*len(self.statistics_columns)
+        self.records.loc[len(self.records.index)] = [str(qid), agent, answer, *ablation_values, n_actual_examples, *statistics_values]
         
-    def log_safe(self, qid, agent, answer, nr_actual_examples=None, raw=None, config: LLMConfig = None):
+    def log_safe(self, qid, agent, answer, nr_actual_examples=None, raw=None, config: LLMConfig = None, statistics: dict = None):
         if not self.is_answered(qid, agent, config):
-            self.log(qid, agent, answer, nr_actual_examples, raw, config)
+            self.log(qid, agent, answer, nr_actual_examples, raw, config, statistics)
 
     def get_answer(self, qid, agent, config: LLMConfig = None):
         conditions = [self.records["qid"] == qid, self.records["agent"] == agent]
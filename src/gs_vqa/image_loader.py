@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from torchvision.io import read_image, ImageReadMode
+from constants import GQA_DATAPATH
+import time
+import os
+
+
+def load_image(image_id):
+    return read_image(os.path.join(GQA_DATAPATH, "images", f"{image_id}.jpg"), ImageReadMode.RGB)
+
+
+class ImageLoader:
+    """Decodes GQA images on a thread pool before they are needed.
+
+    prefetch wraps an iterator and decodes the images of the next lookahead items in the background,
+    load returns a decoded image and keeps the last cache_size images (LRU), so images shared by several
+    questions are decoded once. hits count the loads served from the cache or a prefetch, misses the loads
+    decoded on the spot, wait_sec sums the time load was blocked on decoding.
+    """
+
+    def __init__(self, workers=4, lookahead=16, cache_size=32):
+        self.lookahead = lookahead
+        self.cache_size = cache_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.wait_sec = 0.0
+
+    def _remember(self, image_id, image):
+        self.cache[image_id] = image
+        self.cache.move_to_end(image_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _submit(self, image_id):
+        if image_id not in self.cache and image_id not in self.pending:
+            self.pending[image_id] = self.executor.submit(load_image, image_id)
+
+    def _collect(self, image_id):
+        # moves a prefetched image into the cache, also if the consumer skipped it
+        if image_id in self.pending:
+            self._remember(image_id, self.pending.pop(image_id).result())
+
+    def load(self, image_id):
+        if image_id in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(image_id)
+            return self.cache[image_id]
+
+        start = time.perf_counter()
+        if image_id in self.pending:
+            self.hits += 1
+            image = self.pending.pop(image_id).result()
+        else:
+            self.misses += 1
+            image = load_image(image_id)
+        self.wait_sec += time.perf_counter() - start
+        self._remember(image_id, image)
+        return image
+
+    def prefetch(self, items, image_id=lambda item: item[2]["imageId"]):
+        """Yields the items (by default the (scene_graph, qid, question) tuples of question_iterator) while the
+        images of the following lookahead items are decoded."""
+        window = deque()
+        for item in items:
+            window.append(item)
+            self._submit(image_id(item))
+            if len(window) > self.lookahead:
+                current = window.popleft()
+                yield current
+                self._collect(image_id(current))
+        while len(window) > 0:
+            current = window.popleft()
+            yield current
+            self._collect(image_id(current))
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
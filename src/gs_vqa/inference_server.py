@@ -0,0 +1,209 @@
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
+from contextlib import nullcontext
+from transformers import BatchEncoding, BatchFeature
+from operator import attrgetter
+import torch.multiprocessing
+import threading
+import torch
+import os
+
+from constants import INFERENCE_SOCKET
+from .model.base_model import BaseModel
+from .model.clip_model import normalize_clip_images, clip_logits
+from .model.embedding_cache import EmbeddingCache
+from .object_detection.object_detector import BaseObjectDetector
+
+
+def share_tensors_as_files():
+    # tensors are passed as shared memory files, only their names go through the socket
+    torch.multiprocessing.set_sharing_strategy("file_system")
+
+
+def authkey_path(address):
+    """File holding the key that clients of the server at address authenticate with."""
+    return f"{address}.key"
+
+
+def write_authkey(address):
+    authkey = os.urandom(32)
+    # readable by the user running the server only
+    with open(os.open(authkey_path(address), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as key_file:
+        key_file.write(authkey)
+    return authkey
+
+
+def read_authkey(address):
+    with open(authkey_path(address), "rb") as key_file:
+        return key_file.read()
+
+
+def to_device(obj, device):
+    """Moves the tensors in (nested lists, tuples and dicts of) obj to device."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to(device)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_device(o, device) for o in obj)
+    if isinstance(obj, dict):
+        return {key: to_device(value, device) for key, value in obj.items()}
+    if isinstance(obj, (BatchEncoding, BatchFeature)):
+        return obj.to(device)
+    return obj
+
+
+class InferenceServer:
+    """Hosts models for the processes of a machine on a Unix socket, so they are loaded once.
+
+    models maps names to the hosted objects. A request (name, attribute, args, kwargs) calls a public method
+    of a model, or reads a (dotted) public attribute if args is None. Tensor arguments are moved to the
+    device of the model, tensor results to the cpu. Each connection is served by its own thread. The calls
+    run one at a time, except for thread safe models (e.g. a BatchingModel, which batches concurrent calls).
+
+    Requests are unpickled, so clients have to authenticate with authkey. Without one, a random key is
+    written to authkey_path(address), where InferenceClient reads it.
+    """
+
+    def __init__(self, models, address=INFERENCE_SOCKET, authkey=None):
+        self.models = models
+        self.address = address
+        self.authkey = authkey
+        self.lock = threading.Lock()
+
+    def serve_forever(self):
+        share_tensors_as_files()
+        authkey = self.authkey if self.authkey is not None else write_authkey(self.address)
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        with Listener(self.address, family="AF_UNIX", authkey=authkey) as listener:
+            while True:
+                try:
+                    connection = listener.accept()
+                except (AuthenticationError, EOFError, ConnectionError):
+                    continue
+                threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+
+    def _handle(self, name, attribute, args, kwargs):
+        if any(part.startswith("_") for part in attribute.split(".")):
+            raise AttributeError(f"{attribute} is not public")
+        model = self.models[name]
+        if args is None:
+            return to_device(attrgetter(attribute)(model), "cpu")
+        lock = nullcontext() if getattr(model, "thread_safe", False) else self.lock
+        with lock, torch.no_grad():
+            result = getattr(model, attribute)(*to_device(args, model.gpu), **to_device(kwargs, model.gpu))
+        return to_device(result, "cpu")
+
+    def _serve_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    return
+                try:
+                    response = ("ok", self._handle(*request))
+                except Exception as e:
+                    response = ("error", e)
+                try:
+                    connection.send(response)
+                except Exception as e:
+                    # e.g. an exception that cannot be pickled
+                    connection.send(("error", RuntimeError(repr(response[1]) if response[0] == "error" else repr(e))))
+
+
+class InferenceClient:
+    """Connection to an InferenceServer. Requests of several threads are sent one at a time. authkey defaults
+    to the key the server wrote next to its socket."""
+
+    def __init__(self, address=INFERENCE_SOCKET, authkey=None):
+        share_tensors_as_files()
+        authkey = authkey if authkey is not None else read_authkey(address)
+        self.connection = Client(address, family="AF_UNIX", authkey=authkey)
+        self.lock = threading.Lock()
+
+    def request(self, name, attribute, args=None, kwargs=None):
+        with self.lock:
+            self.connection.send((name, attribute, args, kwargs or {}))
+            status, result = self.connection.recv()
+        if status == "error":
+            raise result
+        return result
+
+    def close(self):
+        self.connection.close()
+
+
+class RemoteConceptModel(BaseModel):
+    """CLIPModel hosted by an InferenceServer. The text features are cached by the server, the features of
+    image crops in the image_cache of this client (see asp_encoding.scene_encoding.crop_features). Images are
+    normalized and features scored locally, the encoders run on the server."""
+
+    def __init__(self, client=None, name="concept_model", image_cache=None):
+        self.client = client if client is not None else InferenceClient()
+        self.name = name
+        super().__init__(img_size=self.client.request(name, "img_size"), gpu=torch.device("cpu"))
+        self.model_id = self.client.request(name, "model_id")
+        self.image_processor = self.client.request(name, "image_processor")
+        self.logit_scale = self.client.request(name, "model.logit_scale")
+        self.image_cache = image_cache if image_cache is not None else EmbeddingCache()
+
+    def preprocess_images(self, images):
+        return self.client.request(self.name, "preprocess_images", (images,))
+
+    def preprocess_texts(self, texts):
+        return self.client.request(self.name, "preprocess_texts", (texts,))
+
+    def score(self, images, texts):
+        return self.client.request(self.name, "score", (images, texts))
+
+    def get_image_features(self, images):
+        return self.client.request(self.name, "get_image_features", (images,))
+
+    def get_pixel_features(self, pixel_values):
+        return self.client.request(self.name, "get_pixel_features", (pixel_values,))
+
+    def get_text_features(self, texts):
+        return self.client.request(self.name, "get_text_features", (texts,))
+
+    def normalize_images(self, images):
+        return normalize_clip_images(images, self.image_processor)
+
+    def score_features(self, image_features, text_features):
+        return clip_logits(image_features, text_features, self.logit_scale)
+
+
+class RemoteObjectDetector(BaseObjectDetector):
+    """OWLViTObjectDetector hosted by an InferenceServer."""
+
+    def __init__(self, client=None, name="object_detector"):
+        super().__init__(torch.device("cpu"))
+        self.client = client if client is not None else InferenceClient()
+        self.name = name
+        self.model_id = self.client.request(name, "model_id")
+
+    def embed_queries(self, text_queries):
+        return self.client.request(self.name, "embed_queries", (text_queries,))
+
+    def detect_objects(self, image, classes, threshold=0.1, k=20):
+        return self.client.request(self.name, "detect_objects", (image, classes, threshold, k))
+
+    def detect_object_groups(self, image, query_groups):
+        return self.client.request(self.name, "detect_object_groups", (image, query_groups))
+
+
+if __name__ == "__main__":
+    # python -m gs_vqa.inference_server [--inference-mode int8] [--max-wait-ms 5], then set USE_INFERENCE_SERVER in eval_full_pipeline
+    import argparse
+    from .model.batching_model import BatchingModel
+    from .model.pipeline_models import load_pipeline_models
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inference-mode", default="fp32")
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=0.0, help="batch the CLIP calls of concurrent clients if > 0")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    concept_model, object_detector = load_pipeline_models(device, args.inference_mode)
+    if args.max_wait_ms > 0:
+        concept_model = BatchingModel(concept_model, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    InferenceServer({"concept_model": concept_model, "object_detector": object_detector}).serve_forever()
@@ -23,4 +23,8 @@ class BaseModel(ABC):
     
     @abstractmethod
     def get_text_features(self, texts):
-        pass
\ No newline at end of file
+        pass
+
+    @abstractmethod
+    def score_features(self, image_features, text_features):
+        pass
@@ -0,0 +1,142 @@
+from concurrent.futures import Future
+from .base_model import BaseModel
+import threading
+import queue
+import time
+import torch
+
+
+class BatchingModel(BaseModel):
+    """Runs the feature requests of concurrent callers (e.g. the connections of an InferenceServer) on a concept
+    model in joint batches.
+
+    A request waits at most max_wait_ms for others, or until the collected requests hold max_batch_size items.
+    The collected requests of the same kind (pixel values, texts or images) run as one call of the model and
+    their results are split again. score is computed from batched image and text features. requests, batches
+    and items count the requests, the model calls and the rows computed, wait_sec sums the time requests
+    waited for their batch and busy_sec the time spent in the model (see metrics).
+    """
+
+    # all model calls run in the batching thread
+    thread_safe = True
+
+    def __init__(self, concept_model, max_batch_size=64, max_wait_ms=5.0):
+        super().__init__(img_size=concept_model.img_size, gpu=concept_model.gpu)
+        self.concept_model = concept_model
+        self.model = getattr(concept_model, "model", None)
+        self.model_id = concept_model.model_id
+        self.image_cache = concept_model.image_cache
+        self.image_processor = concept_model.image_processor
+        self.max_batch_size = max_batch_size
+        self.max_wait_sec = max_wait_ms / 1000
+
+        self.requests = 0
+        self.batches = 0
+        self.items = 0
+        self.wait_sec = 0.0
+        self.busy_sec = 0.0
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def _submit(self, kind, inputs):
+        future = Future()
+        self.queue.put((kind, inputs, future, time.perf_counter()))
+        return future.result()
+
+    def _collect(self):
+        """Blocks for the next request and returns it with the requests arriving until its deadline or a full batch."""
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch, size = [first], len(first[1])
+        deadline = first[3] + self.max_wait_sec
+        while size < self.max_batch_size:
+            try:
+                request = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                # close after this batch
+                self.queue.put(None)
+                break
+            batch.append(request)
+            size += len(request[1])
+        return batch
+
+    @torch.no_grad()
+    def _run_batch(self, kind, requests):
+        if kind == "pixel_values":
+            inputs = torch.cat([inputs for _, inputs, _, _ in requests])
+            outputs = self.concept_model.get_pixel_features(inputs)
+        elif kind == "texts":
+            inputs = [text for _, texts, _, _ in requests for text in texts]
+            outputs = self.concept_model.get_text_features(inputs)
+        else:
+            inputs = [image for _, images, _, _ in requests for image in images]
+            outputs = self.concept_model.get_image_features(inputs)
+
+        start = 0
+        for _, inputs, future, _ in requests:
+            future.set_result(outputs[start:start+len(inputs)])
+            start += len(inputs)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            for kind in dict.fromkeys(request[0] for request in batch):
+                requests = [request for request in batch if request[0] == kind]
+                try:
+                    self._run_batch(kind, requests)
+                except Exception as e:
+                    for _, _, future, _ in requests:
+                        if not future.done():
+                            future.set_exception(e)
+                self.batches += 1
+                self.items += sum(len(request[1]) for request in requests)
+            self.requests += len(batch)
+            self.wait_sec += sum(start - request[3] for request in batch)
+            self.busy_sec += time.perf_counter() - start
+
+    def close(self):
+        """Stops the batching thread once the pending requests are done."""
+        self.queue.put(None)
+        self.worker.join()
+
+    def metrics(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.items / max(self.batches, 1),
+            "items_per_sec": self.items / max(self.busy_sec, 1e-9),
+            "mean_wait_ms": 1000 * self.wait_sec / max(self.requests, 1),
+        }
+
+    def preprocess_images(self, images):
+        return self.concept_model.preprocess_images(images)
+
+    def preprocess_texts(self, texts):
+        return self.concept_model.preprocess_texts(texts)
+
+    def score(self, images, texts):
+        image_features = self.get_image_features(images)
+        text_features = self.get_text_features(texts).to(image_features.dtype)
+        return self.score_features(image_features.unsqueeze(1), text_features.unsqueeze(0))
+
+    def get_image_features(self, images):
+        return self._submit("images", list(images))
+
+    def get_pixel_features(self, pixel_values):
+        return self._submit("pixel_values", pixel_values)
+
+    def get_text_features(self, texts):
+        return self._submit("texts", list(texts))
+
+    def normalize_images(self, images):
+        return self.concept_model.normalize_images(images)
+
+    def score_features(self, image_features, text_features):
+        return self.concept_model.score_features(image_features, text_features)
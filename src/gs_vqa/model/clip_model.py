@@ -1,12 +1,41 @@
 from .base_model import BaseModel
+from .embedding_cache import EmbeddingCache
+from .inference_mode import prepare_model, mode_model_id, autocast
 from transformers import CLIPModel as TCLIPModel, CLIPImageProcessor, CLIPTokenizer
 import torch
 from PIL import Image
 
+def normalize_clip_images(images, image_processor):
+    """Rescales and normalizes a float (N, 3, H, W) batch of 0-255 images like the image processor."""
+    mean = torch.tensor(image_processor.image_mean, device=images.device).view(1, 3, 1, 1)
+    std = torch.tensor(image_processor.image_std, device=images.device).view(1, 3, 1, 1)
+    return (images * image_processor.rescale_factor - mean) / std
+
+
+def clip_logits(image_features, text_features, logit_scale):
+    """Logits of aligned rows of image and text features (broadcasting), as CLIP computes them for every image and text."""
+    image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+    text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+    return logit_scale.exp() * (image_features * text_features).sum(dim=-1)
+
+
 class CLIPModel(BaseModel):
-    def __init__(self, gpu, model="openai/clip-vit-base-patch32", snapshot=None, use_open=False, image_kwargs={}):
+    """CLIP concept model. Text features are cached by (model id, text) in text_cache, an in-memory
+    EmbeddingCache unless one (e.g. with a disk tier) is passed. image_cache holds the features of
+    image crops for asp_encoding.scene_encoding.crop_features.
+
+    inference_mode selects fp32, int8, bf16 or compile inference (see inference_mode.INFERENCE_MODES) of the
+    transformers model. Features of the approximate modes are cached under a model id with the mode appended.
+    """
+
+    def __init__(self, gpu, model="openai/clip-vit-base-patch32", snapshot=None, use_open=False, image_kwargs={}, text_cache=None,
+                 image_cache=None, inference_mode="fp32"):
         super().__init__(img_size=224, gpu=gpu)
         self.use_open = use_open
+        self.inference_mode = "fp32"
+        self.model_id = snapshot if snapshot is not None else model
+        self.text_cache = text_cache if text_cache is not None else EmbeddingCache()
+        self.image_cache = image_cache if image_cache is not None else EmbeddingCache()
 
         if use_open:
             self.model, _, self.image_processor = open_clip.create_model_and_transforms('ViT-H-14', pretrained='laion2b_s32b_b79k')
@@ -16,6 +45,17 @@ class CLIPModel(BaseModel):
             self.model = TCLIPModel.from_pretrained(snapshot if snapshot is not None else model).to(gpu)
             self.image_processor = CLIPImageProcessor.from_pretrained(model, **image_kwargs)
             self.tokenizer = CLIPTokenizer.from_pretrained(model)
+            self.model, self.inference_mode = prepare_model(self.model, inference_mode, gpu)
+            self.model_id = mode_model_id(self.model_id, self.inference_mode)
+            if self.inference_mode == "compile":
+                self.warm_up()
+
+    @torch.no_grad()
+    def warm_up(self, batch_size=2):
+        """Runs both towers once on dummy inputs, e.g. to compile them before the first timed call."""
+        with autocast(self.inference_mode, self.gpu):
+            self.model.get_image_features(pixel_values=torch.zeros(batch_size, 3, self.img_size, self.img_size, device=self.gpu))
+            self.model.get_text_features(**self.preprocess_texts(["a photo"] * batch_size))
 
     def preprocess_images(self, images):
         return self.image_processor(images, return_tensors="pt", do_resize=False, do_center_crop=False).to(self.gpu)
@@ -38,17 +78,33 @@ class CLIPModel(BaseModel):
                 text_features /= text_features.norm(dim=-1, keepdim=True)
                 return (100.0 * image_features @ text_features.T).softmax(dim=-1)
 
-        image_inputs = self.preprocess_images(images)
-        text_inputs = self.preprocess_texts(texts)
-        
-        result = self.model(**image_inputs, **text_inputs)
-        return result["logits_per_image"]
+        # same as logits_per_image of the full model, with the text side from the cache
+        image_features = self.get_image_features(images)
+        text_features = self.get_text_features(texts).to(image_features.dtype)
+        return self.score_features(image_features.unsqueeze(1), text_features.unsqueeze(0))
     
     def get_image_features(self, images):
         image_inputs = self.preprocess_images(images)
-        return self.model.get_image_features(**image_inputs)
+        with autocast(self.inference_mode, self.gpu):
+            return self.model.get_image_features(**image_inputs).float()
     
+    def normalize_images(self, images):
+        """Rescales and normalizes a float (N, 3, H, W) batch of 0-255 images like the image processor."""
+        return normalize_clip_images(images, self.image_processor)
+
+    def get_pixel_features(self, pixel_values):
+        """Image features of an already normalized batch, see normalize_images."""
+        with autocast(self.inference_mode, self.gpu):
+            return self.model.get_image_features(pixel_values=pixel_values).float()
+
     def get_text_features(self, texts):
-        text_inputs = self.preprocess_texts(texts)
-        return self.model.get_text_features(**text_inputs)
-        
\ No newline at end of file
+        """Features of texts, encoding each distinct text not in the text cache once."""
+        def encode(keys):
+            text_inputs = self.preprocess_texts([text for _, text in keys])
+            with autocast(self.inference_mode, self.gpu):
+                return self.model.get_text_features(**text_inputs).float()
+        return self.text_cache.get_or_compute([(self.model_id, text) for text in texts], encode, device=self.gpu)
+
+    def score_features(self, image_features, text_features):
+        """Logits of aligned rows of image and text features (broadcasting), as score computes them for every image and text."""
+        return clip_logits(image_features, text_features, self.model.logit_scale)
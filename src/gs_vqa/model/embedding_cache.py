@@ -0,0 +1,187 @@
+from collections import OrderedDict
+import numpy as np
+import torch
+import json
+import os
+
+
+class EmbeddingCache:
+    """Feature vectors keyed by flat tuples of strings and numbers, e.g. (model id, prompt).
+
+    Keeps up to max_entries vectors in memory and evicts the least recently used ones. If a path is
+    given, every vector is also appended to a memory mapped file in that directory and read back from
+    there once it was evicted from memory or in a later run. The disk tier assumes a single writer. The
+    vector width is stored in meta.json, rows of an interrupted append are dropped when the cache is opened.
+    All vectors of a cache have the same width. hits and misses count the lookups of this instance.
+
+    Without max_disk_entries the disk tier grows without limit. With it, the files are rewritten with the
+    3/4 max_disk_entries most recently used vectors once they hold more. The rewritten files are a new
+    generation, which meta.json switches to in one step, so an interrupted rewrite leaves the old files valid.
+    """
+
+    def __init__(self, max_entries=50000, path=None, max_disk_entries=None):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.memory = OrderedDict()
+
+        # in order of use, the most recently used last
+        self.disk_rows = OrderedDict()
+        self.dim = None
+        self._features = None
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self.meta_path = os.path.join(path, "meta.json")
+            self._load_disk()
+
+    def __len__(self):
+        return len(self.memory)
+
+    def _set_generation(self, generation):
+        self.generation = generation
+        suffix = f".{generation}" if generation > 0 else ""
+        self.features_path = os.path.join(self.path, f"features{suffix}.f32")
+        self.index_path = os.path.join(self.path, f"index{suffix}.jsonl")
+
+    def _load_disk(self):
+        meta = {}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as meta_file:
+                meta = json.load(meta_file)
+        self.dim = meta.get("dim")
+        self._set_generation(meta.get("generation", 0))
+        # files of other generations are left by an interrupted rewrite
+        for name in os.listdir(self.path):
+            file_path = os.path.join(self.path, name)
+            if name.startswith(("features", "index")) and file_path not in (self.features_path, self.index_path):
+                os.remove(file_path)
+
+        lines, partial_line = [], False
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                for line in index_file:
+                    # a line without newline is the partial last line of an interrupted append
+                    if not line.endswith("\n"):
+                        partial_line = True
+                        break
+                    lines.append(line)
+        feature_bytes = os.path.getsize(self.features_path) if os.path.exists(self.features_path) else 0
+
+        if self.dim is None and len(lines) > 0:
+            # written before the width was stored, only usable if the file holds exactly the indexed rows
+            if feature_bytes % (4 * len(lines)) != 0:
+                raise ValueError(f"cannot infer the vector width of {self.path}, delete the cache")
+            self.dim = feature_bytes // (4 * len(lines))
+            self._write_meta()
+
+        # the feature rows are flushed before their index lines, rows without both are dropped
+        n_rows = min(len(lines), feature_bytes // (4 * self.dim)) if self.dim is not None else 0
+        if n_rows < len(lines) or partial_line:
+            lines = lines[:n_rows]
+            with open(self.index_path, "w") as index_file:
+                index_file.writelines(lines)
+        if n_rows * 4 * (self.dim or 0) < feature_bytes:
+            os.truncate(self.features_path, n_rows * 4 * self.dim)
+
+        for line in lines:
+            key, row = json.loads(line)
+            self.disk_rows[tuple(key)] = row
+
+    def _write_meta(self):
+        with open(f"{self.meta_path}.tmp", "w") as meta_file:
+            json.dump({"dim": self.dim, "generation": self.generation}, meta_file)
+        os.replace(f"{self.meta_path}.tmp", self.meta_path)
+
+    def _compact(self, chunk_size=4096):
+        """Rewrites the disk tier with the 3/4 max_disk_entries most recently used vectors."""
+        kept = list(self.disk_rows)[len(self.disk_rows) - self.max_disk_entries * 3 // 4:]
+        features = self._disk_features()
+        old_paths = (self.features_path, self.index_path)
+        self._set_generation(self.generation + 1)
+        with open(self.features_path, "wb") as features_file:
+            for start in range(0, len(kept), chunk_size):
+                rows = [self.disk_rows[key] for key in kept[start:start+chunk_size]]
+                features_file.write(np.ascontiguousarray(features[rows]).tobytes())
+        with open(self.index_path, "w") as index_file:
+            for row, key in enumerate(kept):
+                index_file.write(json.dumps([list(key), row]) + "\n")
+        self._write_meta()
+
+        self.disk_rows = OrderedDict((key, row) for row, key in enumerate(kept))
+        self._features = None
+        for old_path in old_paths:
+            os.remove(old_path)
+
+    def _disk_features(self):
+        # the memmap is reopened after rows were appended
+        if self._features is None or self._features.shape[0] != len(self.disk_rows):
+            self._features = np.memmap(self.features_path, dtype=np.float32, mode="r", shape=(len(self.disk_rows), self.dim))
+        return self._features
+
+    def _remember(self, key, features):
+        self.memory[key] = features
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """Returns the cached feature vector (cpu tensor) of key or None."""
+        if key in self.disk_rows:
+            self.disk_rows.move_to_end(key)
+        if key in self.memory:
+            self.hits += 1
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if key in self.disk_rows:
+            self.hits += 1
+            features = torch.from_numpy(np.array(self._disk_features()[self.disk_rows[key]]))
+            self._remember(key, features)
+            return features
+        self.misses += 1
+        return None
+
+    def put_many(self, keys, features):
+        """Stores the rows of the features tensor under the given keys."""
+        features = features.detach().to("cpu", torch.float32)
+        if self.dim is not None and features.shape[1] != self.dim:
+            raise ValueError(f"expected features of width {self.dim}, got {features.shape[1]}")
+        if self.dim is None:
+            self.dim = features.shape[1]
+            if self.path is not None:
+                self._write_meta()
+        new_rows = []
+        for key, row in zip(keys, features):
+            # a copy, a view of the row would keep the whole batch alive after the eviction of the others
+            self._remember(key, row.clone())
+            if key in self.disk_rows:
+                self.disk_rows.move_to_end(key)
+            elif self.path is not None:
+                new_rows.append((key, row))
+
+        if len(new_rows) > 0:
+            with open(self.features_path, "ab") as features_file:
+                for key, row in new_rows:
+                    features_file.write(row.numpy().tobytes())
+            with open(self.index_path, "a") as index_file:
+                for key, row in new_rows:
+                    index_file.write(json.dumps([list(key), len(self.disk_rows)]) + "\n")
+                    self.disk_rows[key] = len(self.disk_rows)
+            if self.max_disk_entries is not None and len(self.disk_rows) > self.max_disk_entries:
+                self._compact()
+
+    def get_or_compute(self, keys, compute, device=None):
+        """Returns the stacked features of keys, computing the missing ones in one call compute(missing keys).
+
+        Repeated keys are looked up and computed once.
+        """
+        unique_keys = list(dict.fromkeys(keys))
+        cached = {key: self.get(key) for key in unique_keys}
+        missing_keys = [key for key in unique_keys if cached[key] is None]
+        if len(missing_keys) > 0:
+            computed = compute(missing_keys)
+            self.put_many(missing_keys, computed)
+            cached.update({key: row for key, row in zip(missing_keys, computed.detach().to("cpu", torch.float32))})
+        features = torch.stack([cached[key] for key in keys])
+        return features if device is None else features.to(device)
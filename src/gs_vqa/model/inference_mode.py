@@ -0,0 +1,52 @@
+from torch.ao.quantization import quantize_dynamic
+import warnings
+import torch
+
+# fp32: the model as loaded, int8: linear layers dynamically quantized (cpu only), bf16: bfloat16 autocast,
+# compile: vision and text towers compiled with torch.compile
+INFERENCE_MODES = ["fp32", "int8", "bf16", "compile"]
+
+# modes whose features differ from fp32, they are cached under their own model id
+APPROXIMATE_MODES = ["int8", "bf16"]
+
+
+def bf16_supported(device):
+    if device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    # without native bf16 instructions autocast is emulated and slower than fp32
+    return device.type == "cpu" and torch.cpu._is_avx512_bf16_supported()
+
+
+def prepare_model(model, inference_mode, device, compiled_modules=("vision_model", "text_model")):
+    """Returns the model prepared for inference_mode and the mode actually used.
+
+    bf16 falls back to fp32 (with a warning) on devices without bf16 support. For compile, the submodules
+    named in compiled_modules are replaced by compiled versions, the caller runs a warm-up to compile them.
+    """
+    if inference_mode not in INFERENCE_MODES:
+        raise ValueError(f"unknown inference mode {inference_mode}, expected one of {INFERENCE_MODES}")
+
+    if inference_mode == "int8":
+        if device.type != "cpu":
+            raise ValueError("int8 inference mode is only supported on the cpu")
+        return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8), inference_mode
+
+    if inference_mode == "bf16" and not bf16_supported(device):
+        warnings.warn(f"bf16 is not supported on {device}, using fp32.")
+        return model, "fp32"
+
+    if inference_mode == "compile":
+        for module in list(model.modules()):
+            for name, child in list(module.named_children()):
+                if name in compiled_modules:
+                    setattr(module, name, torch.compile(child, dynamic=True))
+    return model, inference_mode
+
+
+def mode_model_id(model_id, inference_mode):
+    return f"{model_id}:{inference_mode}" if inference_mode in APPROXIMATE_MODES else model_id
+
+
+def autocast(inference_mode, device):
+    """Context for the forward passes of a model prepared with prepare_model."""
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=inference_mode == "bf16")
@@ -0,0 +1,22 @@
+from constants import CACHE_PATH
+from .clip_model import CLIPModel
+from .embedding_cache import EmbeddingCache
+from ..object_detection.owl_vit_object_detector import OWLViTObjectDetector
+import os
+
+
+def load_pipeline_models(device, inference_mode="fp32"):
+    """CLIPModel and OWLViTObjectDetector of the pipeline, with their caches under CACHE_PATH."""
+    from asp_encoding.scene_encoding import precompute_query_embeddings
+
+    concept_model = CLIPModel(device, model="openai/clip-vit-base-patch32",
+                              text_cache=EmbeddingCache(path=os.path.join(CACHE_PATH, "clip_text_features")),
+                              # keyed by image, box and crop mode, capped on disk (about 200 MB of 512 float features)
+                              image_cache=EmbeddingCache(max_entries=20000, path=os.path.join(CACHE_PATH, "clip_crop_features"),
+                                                         max_disk_entries=100000),
+                              inference_mode=inference_mode)
+    object_detector = OWLViTObjectDetector(device, usev2=True,
+                                           query_cache=EmbeddingCache(path=os.path.join(CACHE_PATH, "owl_query_embeddings")),
+                                           inference_mode=inference_mode)
+    precompute_query_embeddings(object_detector)
+    return concept_model, object_detector
@@ -0,0 +1,151 @@
+from transformers.models.owlv2.modeling_owlv2 import Owlv2ObjectDetectionOutput
+from constants import CACHE_PATH, GQA_DATAPATH
+from .owl_vit_object_detector import choose_top_k_objects
+from ..pipeline.detection_merging import merge_objects
+from ..image_loader import ImageLoader
+import numpy as np
+import itertools
+import torch
+import json
+import sys
+import os
+
+# version 2 stores logits instead of sigmoid scores
+INDEX_FORMAT = 2
+
+
+class DetectionIndex:
+    """Offline detections of a fixed query vocabulary, one compressed npz file per image.
+
+    For every image the index stores, as sparse columns (box, label, logit), the logit of every vocabulary
+    query whose score reaches floor on a predicted box, and the boxes (xmin, ymin, xmax, ymax in pixels)
+    referenced. detect_object_groups reproduces OWLViTObjectDetector.detect_object_groups for queries of the
+    vocabulary and thresholds of at least floor, without running the detector. As in the post processing of
+    the detector, the label of a box is the query with the highest logit (the first one on ties), scores
+    saturate too early to compare them. The detections are only valid for the detector whose model_id is
+    stored in the index (see matches).
+    """
+
+    def __init__(self, path=os.path.join(CACHE_PATH, "detection_index"), vocabulary=None, floor=0.01, model_id=None):
+        self.path = path
+        meta_path = os.path.join(path, "index.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if vocabulary is not None and meta.get("format") != INDEX_FORMAT:
+                raise ValueError(f"the detection index in {path} has an old format, delete it to rebuild it")
+            if vocabulary is not None and vocabulary != meta["vocabulary"]:
+                raise ValueError(f"the vocabulary differs from the one of the detection index in {path}")
+            if model_id is not None and model_id != meta["model_id"]:
+                raise ValueError(f"the detection index in {path} was built with {meta['model_id']}, not {model_id}")
+        else:
+            meta = {"vocabulary": vocabulary or [], "floor": floor, "model_id": model_id, "format": INDEX_FORMAT}
+            if vocabulary is not None:
+                os.makedirs(path, exist_ok=True)
+                with open(meta_path, "w") as meta_file:
+                    json.dump(meta, meta_file)
+
+        self.vocabulary = meta["vocabulary"]
+        self.floor = meta["floor"]
+        self.model_id = meta["model_id"]
+        self.format = meta.get("format", 1)
+        self.vocabulary_index = {query: i for i, query in reversed(list(enumerate(self.vocabulary)))}
+
+    def _image_path(self, image_id):
+        return os.path.join(self.path, f"{image_id}.npz")
+
+    def __contains__(self, image_id):
+        return os.path.exists(self._image_path(image_id))
+
+    def matches(self, object_detector):
+        """Whether the index holds the detections of object_detector (same model and inference mode) in the current format."""
+        return self.format == INDEX_FORMAT and self.model_id is not None and self.model_id == object_detector.model_id
+
+    def covers(self, query_group):
+        classes, threshold, _ = query_group
+        return threshold >= self.floor and all(clazz in self.vocabulary_index for clazz in classes)
+
+    def write(self, image_id, boxes, logits):
+        """Stores the boxes (n x 4) and the class logits (n x vocabulary) of all predictions on an image."""
+        box, label = np.nonzero(sigmoid(logits) >= self.floor)
+        # keep only the boxes with a score above the floor, in prediction order
+        kept, box_column = np.unique(box, return_inverse=True)
+        np.savez_compressed(self._image_path(image_id), boxes=boxes[kept].astype(np.float32), box=box_column.astype(np.int32),
+                            label=label.astype(np.int32), logit=logits[box, label].astype(np.float32))
+
+    def detect_objects(self, image_id, classes, threshold=0.1, k=20):
+        entry = np.load(self._image_path(image_id))
+        boxes, box, label, logit = entry["boxes"], entry["box"], entry["label"], entry["logit"]
+
+        # position of each vocabulary entry in classes, the first query wins for repeated names
+        position = np.full(len(self.vocabulary), -1)
+        for i, clazz in reversed(list(enumerate(classes))):
+            position[self.vocabulary_index[clazz]] = i
+        selected = position[label] >= 0
+        box, label, logit = box[selected], position[label[selected]], logit[selected]
+
+        # best query per box, as the detector's post processing takes the maximum logit over the queries
+        order = np.lexsort((label, -logit, box))
+        box, label, logit = box[order], label[order], logit[order]
+        first = np.ones(len(box), dtype=bool)
+        first[1:] = box[1:] != box[:-1]
+        box, label, score = box[first], label[first], sigmoid(logit[first])
+
+        detected_objects = []
+        for b, l, s in zip(box, label, score):
+            if s > threshold:
+                xmin, ymin, xmax, ymax = boxes[b].tolist()
+                detected_objects.append({
+                    "x": xmin,
+                    "y": ymin,
+                    "w": xmax - xmin,
+                    "h": ymax - ymin,
+                    "score": float(s),
+                    "name": classes[l]
+                })
+
+        return choose_top_k_objects(merge_objects(detected_objects, overlap_threshold=0.6), k)
+
+    def detect_object_groups(self, image_id, query_groups):
+        return [self.detect_objects(image_id, classes, threshold, k) for classes, threshold, k in query_groups]
+
+
+def sigmoid(logits):
+    # computed by torch in float32 like the scores of the detector's post processing
+    return torch.sigmoid(torch.from_numpy(np.asarray(logits, dtype=np.float32))).numpy()
+
+
+@torch.no_grad()
+def index_image(object_detector, index, image_id, image, query_embeds=None):
+    """Runs the detector on an image over the whole vocabulary of the index and writes its predictions."""
+    if query_embeds is None:
+        query_embeds = object_detector.embed_queries(index.vocabulary).unsqueeze(0)
+    image_feats, pred_boxes = object_detector.embed_image(image)
+    logits = object_detector.class_logits(image_feats, query_embeds)
+    # boxes of all predictions, converted as in the post processing of the detector
+    target_sizes = torch.tensor([(image.shape[1], image.shape[2])])
+    outputs = Owlv2ObjectDetectionOutput(logits=logits.to("cpu"), pred_boxes=pred_boxes.to("cpu"))
+    boxes = object_detector.processor.post_process_object_detection(outputs, threshold=-1.0, target_sizes=target_sizes)[0]["boxes"]
+    index.write(image_id, boxes.numpy(), logits[0].to("cpu").numpy())
+
+
+def build_detection_index(object_detector, image_ids, index):
+    """Runs the detector once per image over the whole vocabulary of the index. Images already in the index are skipped."""
+    query_embeds = object_detector.embed_queries(index.vocabulary).unsqueeze(0)
+    image_loader = ImageLoader(cache_size=1)
+    for image_id in image_loader.prefetch([image_id for image_id in image_ids if image_id not in index], image_id=lambda i: i):
+        index_image(object_detector, index, image_id, image_loader.load(image_id), query_embeds)
+    image_loader.close()
+
+
+if __name__ == "__main__":
+    # python -m gs_vqa.object_detection.detection_index [image ids]
+    from .owl_vit_object_detector import OWLViTObjectDetector
+    with open(os.path.join(GQA_DATAPATH, "metadata", "gqa_all_class.json")) as f:
+        all_classes = json.load(f)
+    vocabulary = list(dict.fromkeys(c.replace("_", " ") for c in itertools.chain(*all_classes.values())))
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    detector = OWLViTObjectDetector(device, usev2=True)
+    image_ids = sys.argv[1:] or [f[:-len(".jpg")] for f in sorted(os.listdir(os.path.join(GQA_DATAPATH, "images"))) if f.endswith(".jpg")]
+    build_detection_index(detector, image_ids, DetectionIndex(vocabulary=vocabulary, model_id=detector.model_id))
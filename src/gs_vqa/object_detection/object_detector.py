@@ -6,4 +6,8 @@ class BaseObjectDetector(ABC):
     
     @abstractmethod
     def detect_objects(self, image, classes, threshold, k):
-        pass
\ No newline at end of file
+        pass
+
+    def detect_object_groups(self, image, query_groups):
+        """Detects objects for several (classes, threshold, k) query groups on the same image, one list per group."""
+        return [self.detect_objects(image, classes, threshold, k) for classes, threshold, k in query_groups]
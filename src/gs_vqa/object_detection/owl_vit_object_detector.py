@@ -1,14 +1,30 @@
 import torch
 from transformers import AutoProcessor, AutoModelForZeroShotObjectDetection
 from transformers import Owlv2Processor, Owlv2ForObjectDetection
+from transformers.models.owlv2.modeling_owlv2 import Owlv2ObjectDetectionOutput
 import torchvision.transforms.functional as F
 
 from .object_detector import BaseObjectDetector
+from ..model.embedding_cache import EmbeddingCache
+from ..model.inference_mode import prepare_model, mode_model_id, autocast
+from ..pipeline.detection_merging import merge_objects
+
+
+def choose_top_k_objects(objects, k):
+    if k is None:
+        return objects
+    return sorted(objects, key=lambda o: o["score"], reverse=True)[:k]
 
 
 class OWLViTObjectDetector(BaseObjectDetector):
-    def __init__(self, gpu, model="google/owlvit-large-patch14", usev2: bool = False):
+    """OWL-ViT / OWLv2 detector. Text query embeddings are cached by (model id, query) in query_cache, an
+    in-memory EmbeddingCache unless one (e.g. with a disk tier) is passed. inference_mode selects fp32, int8,
+    bf16 or compile inference as for CLIPModel."""
+
+    def __init__(self, gpu, model="google/owlvit-large-patch14", usev2: bool = False, query_cache=None, inference_mode="fp32"):
         super().__init__(gpu)
+        self.model_id = "google/owlv2-base-patch16-ensemble" if usev2 else model
+        self.query_cache = query_cache if query_cache is not None else EmbeddingCache()
 
         if usev2:
             self.model = Owlv2ForObjectDetection.from_pretrained("google/owlv2-base-patch16-ensemble").to(gpu)
@@ -17,63 +33,57 @@ class OWLViTObjectDetector(BaseObjectDetector):
             self.model = AutoModelForZeroShotObjectDetection.from_pretrained(model).to(gpu)
             self.processor = AutoProcessor.from_pretrained(model)
 
-    def __should_merge__(self, box1, box2, overlap_threshold):
-        YA1, XA1, YA2, XA2 = box1 
-        YB1, XB1, YB2, XB2 = box2
-        box1_area = (YA2 - YA1) * (XA2 - XA1)
-        box2_area = (YB2 - YB1) * (XB2 - XB1)
-        intersection_area = max(0, min(XA2, XB2) - max(XA1, XB1)) * max(0, min(YA2, YB2) - max(YA1, YB1))
-        union_area = box1_area + box2_area - intersection_area
-
-        if intersection_area / union_area > overlap_threshold:
-            return True, (
-                min(box1[0], box2[0]),
-                min(box1[1], box2[1]),
-                max(box1[2], box2[2]),
-                max(box1[3], box2[3]),
-            )
-
-        return False, None
-
-    def __merge_objects__(self, objects, overlap_threshold):
-        for k in range(len(objects)):
-            object1 = objects[k]
-            for l in range(k+1, len(objects)):
-                object2 = objects[l]
-                if object1["name"] == object2["name"]:
-                    is_merge, new_box = self.__should_merge__(
-                        (object1['y'], object1['x'], object1['y']+object1['h'], object1['x']+object1['w']), 
-                        (object2['y'], object2['x'], object2['y']+object2['h'], object2['x']+object2['w']), overlap_threshold
-                    )
-                    if is_merge:
-                        objects[k] = None
-                        objects[l] = {
-                            "y": new_box[0],
-                            "x": new_box[1],
-                            "h": new_box[2]-new_box[0],
-                            "w": new_box[3]-new_box[1],
-                            "name": object1["name"],
-                            "score": max(object1["score"], object2["score"])
-                        }
-                        break
-
-        return [b for b in objects if b]
-
-    def __choose_top_k_objects__(self, objects, k):
-        return sorted(objects, key=lambda o: o["score"], reverse=True)[:k]
+        self.model, self.inference_mode = prepare_model(self.model, inference_mode, gpu)
+        self.model_id = mode_model_id(self.model_id, self.inference_mode)
+        if self.inference_mode == "compile":
+            self.warm_up()
 
     @torch.no_grad()
-    def detect_objects(self, image, classes, threshold=0.1, k=20):
-        text_queries = classes
-        inputs = self.processor(text=text_queries, images=F.to_pil_image(image), return_tensors="pt").to(self.gpu)
+    def warm_up(self):
+        """Runs the detector once on a dummy image and query, e.g. to compile it before the first timed call."""
+        image_feats, _ = self.embed_image(torch.zeros(3, 64, 64, dtype=torch.uint8))
+        inputs = self.processor(text=["a photo", "an object"], return_tensors="pt").to(self.gpu)
+        with autocast(self.inference_mode, self.gpu):
+            query_embeds = self.model.base_model.get_text_features(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])
+        self.class_logits(image_feats, query_embeds.float().unsqueeze(0))
 
-        outputs = self.model(**inputs)
-        outputs.logits = outputs.logits.to("cpu")
-        outputs.pred_boxes = outputs.pred_boxes.to("cpu")
+    @torch.no_grad()
+    def embed_image(self, image):
+        """Runs the vision backbone once. Returns the patch features and the predicted box of every patch."""
+        inputs = self.processor(images=F.to_pil_image(image), return_tensors="pt").to(self.gpu)
+        with autocast(self.inference_mode, self.gpu):
+            feature_map = self.model.image_embedder(pixel_values=inputs["pixel_values"])[0]
+            batch_size, num_patches_height, num_patches_width, hidden_dim = feature_map.shape
+            image_feats = torch.reshape(feature_map, (batch_size, num_patches_height * num_patches_width, hidden_dim))
+            pred_boxes = self.model.box_predictor(image_feats, feature_map)
+        return image_feats.float(), pred_boxes.float()
+
+    @torch.no_grad()
+    def class_logits(self, image_feats, query_embeds):
+        """Logits of every patch (rows) for every query (columns) of a (1, queries, dim) batch of query embeddings."""
+        query_mask = torch.ones(query_embeds.shape[:2], dtype=torch.bool, device=query_embeds.device)
+        with autocast(self.inference_mode, self.gpu):
+            return self.model.class_predictor(image_feats, query_embeds, query_mask)[0].float()
 
+    @torch.no_grad()
+    def embed_queries(self, text_queries, batch_size=256):
+        """Normalized embeddings of the text queries, as the detection model computes them. Queries missing in
+        the query cache are encoded in batches of batch_size."""
+        def encode(keys):
+            query_embeds = []
+            for start in range(0, len(keys), batch_size):
+                inputs = self.processor(text=[query for _, query in keys[start:start+batch_size]], return_tensors="pt").to(self.gpu)
+                with autocast(self.inference_mode, self.gpu):
+                    query_embeds.append(self.model.base_model.get_text_features(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"]))
+            query_embeds = torch.cat(query_embeds).float()
+            return query_embeds / torch.linalg.norm(query_embeds, ord=2, dim=-1, keepdim=True)
+        return self.query_cache.get_or_compute([(self.model_id, query) for query in text_queries], encode, device=self.gpu)
+
+    def __postprocess__(self, image, text_queries, logits, pred_boxes, threshold, k):
+        outputs = Owlv2ObjectDetectionOutput(logits=logits.to("cpu"), pred_boxes=pred_boxes.to("cpu"))
         target_sizes = torch.tensor([(image.shape[1], image.shape[2])])
         results = self.processor.post_process_object_detection(outputs, threshold=threshold, target_sizes=target_sizes)[0]
-    
+
         scores = results["scores"].tolist()
         labels = results["labels"].tolist()
         boxes = results["boxes"].tolist()
@@ -90,13 +100,29 @@ class OWLViTObjectDetector(BaseObjectDetector):
                 "name": text_queries[label]
             })
 
-        merged_objects = self.__merge_objects__(detected_objects, overlap_threshold=0.6)
-
-        if k is not None:
-            top_k_objects = self.__choose_top_k_objects__(merged_objects, k)
-        else:
-            top_k_objects = merged_objects
+        return choose_top_k_objects(merge_objects(detected_objects, overlap_threshold=0.6), k)
 
-        del inputs, outputs, results
+    @torch.no_grad()
+    def detect_object_groups(self, image, query_groups):
+        """Detects objects for several (classes, threshold, k) query groups on the same image, one list per group.
+
+        The image is embedded once and all distinct queries are encoded in one batch, only the class head
+        and the post processing (threshold, merging, top k) run per group.
+        """
+        image_feats, pred_boxes = self.embed_image(image)
+
+        query_indices = {}
+        for classes, _, _ in query_groups:
+            for clazz in classes:
+                query_indices.setdefault(clazz, len(query_indices))
+        query_embeds = self.embed_queries(list(query_indices))
+
+        groups_objects = []
+        for classes, threshold, k in query_groups:
+            group_embeds = query_embeds[[query_indices[clazz] for clazz in classes]].unsqueeze(0)
+            logits = self.class_logits(image_feats, group_embeds)
+            groups_objects.append(self.__postprocess__(image, classes, logits, pred_boxes, threshold, k))
+        return groups_objects
 
-        return top_k_objects
\ No newline at end of file
+    def detect_objects(self, image, classes, threshold=0.1, k=20):
+        return self.detect_object_groups(image, [(classes, threshold, k)])[0]
@@ -55,10 +55,57 @@ def merge_boxes(boxes, overlap_threshold):
     boxes = [b for b in boxes if b]
     return boxes 
 
-def get_pair_bboxes(objects, merge_threshold = 0.7):
+def pair_union_boxes(objects):
+    """Pairs (i, j), i < j, in row-major order and their joint (ymin, xmin, ymax, xmax) boxes."""
+    i, j = np.triu_indices(len(objects), k=1)
+    boxes = np.array([(o['y'], o['x'], o['y'] + o['h'], o['x'] + o['w']) for o in objects], dtype=np.float64).reshape(-1, 4)
+    return i, j, np.concatenate([np.minimum(boxes[i, :2], boxes[j, :2]), np.maximum(boxes[i, 2:], boxes[j, 2:])], axis=1)
+
+def box_overlaps(box, boxes):
+    """IoU of one (ymin, xmin, ymax, xmax) box with each row of boxes, computed as in should_merge."""
+    intersection = np.clip(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0, None) \
+        * np.clip(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return intersection / (areas + (box[2] - box[0]) * (box[3] - box[1]) - intersection)
+
+def cluster_boxes(boxes, overlap_threshold):
+    """Vectorized merge_boxes: the cluster of every box and the merged boxes of the clusters, in the same order.
+
+    Box k is compared with all later (possibly already merged) boxes at once and merges into the first one
+    above overlap_threshold. Merged boxes point to the box they were merged into, following these links
+    (towards higher indices) gives the cluster of each box.
+    """
+    boxes = boxes.copy()
+    merged_into = np.arange(len(boxes))
+    for k in range(len(boxes) - 1):
+        candidates = np.flatnonzero(box_overlaps(boxes[k], boxes[k+1:]) > overlap_threshold)
+        if len(candidates) == 0:
+            continue
+
+        l = k + 1 + candidates[0]
+        boxes[l, :2] = np.minimum(boxes[k, :2], boxes[l, :2])
+        boxes[l, 2:] = np.maximum(boxes[k, 2:], boxes[l, 2:])
+        merged_into[k] = l
+
+    cluster = merged_into.copy()
+    for k in reversed(range(len(boxes))):
+        cluster[k] = cluster[merged_into[k]]
+    kept = merged_into == np.arange(len(boxes))
+    rank = np.cumsum(kept) - 1
+    return rank[cluster], boxes[kept]
+
+def get_pair_bboxes(objects, merge_threshold = 0.7, vectorized=True):
     num_objects = len(objects)
     bbox_indices = np.full([num_objects, num_objects], -1)
-    
+
+    if vectorized:
+        i, j, joined_bboxes = pair_union_boxes(objects)
+        cluster, merged_boxes = cluster_boxes(joined_bboxes, merge_threshold)
+        bbox_indices[i, j] = cluster
+        bbox_indices[j, i] = cluster
+        return [tuple(box) for box in merged_boxes.tolist()], bbox_indices
+
     joined_bboxes = []
     for i in range(num_objects):
         for j in range(i+1, num_objects):
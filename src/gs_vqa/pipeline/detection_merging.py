@@ -0,0 +1,66 @@
+from torchvision.ops import box_iou
+import torch
+
+
+def category_index(categories):
+    """Maps every class of a {category: [classes]} dict to the set of its categories."""
+    class_categories = {}
+    for category, classes in categories.items():
+        for clazz in classes:
+            class_categories.setdefault(clazz, set()).add(category)
+    return class_categories
+
+
+def object_boxes(objects):
+    """(x1, y1, x2, y2) boxes of detected objects as a float64 tensor, as box_iou expects them."""
+    return torch.tensor([(o["x"], o["y"], o["x"] + o["w"], o["y"] + o["h"]) for o in objects], dtype=torch.float64).view(-1, 4)
+
+
+def merge_objects(objects, overlap_threshold):
+    """Greedily merges overlapping detections of the same name into their joint box.
+
+    Each detection is merged into the first later detection of the same name whose (possibly already merged)
+    box overlaps it with an IoU above overlap_threshold, which then takes the joint box and the higher score.
+    """
+    boxes = object_boxes(objects)
+    name_ids = {}
+    names = torch.tensor([name_ids.setdefault(o["name"], len(name_ids)) for o in objects])
+    merged = list(objects)
+    for k in range(len(objects) - 1):
+        later = torch.arange(k + 1, len(objects))
+        same_name = names[k+1:] == names[k]
+        candidates = later[same_name & (box_iou(boxes[k:k+1], boxes[k+1:])[0] > overlap_threshold)]
+        if len(candidates) == 0:
+            continue
+
+        l = candidates[0].item()
+        x1, y1 = torch.minimum(boxes[k, :2], boxes[l, :2]).tolist()
+        x2, y2 = torch.maximum(boxes[k, 2:], boxes[l, 2:]).tolist()
+        merged[l] = {
+            "y": y1,
+            "x": x1,
+            "h": y2 - y1,
+            "w": x2 - x1,
+            "name": merged[k]["name"],
+            "score": max(merged[k]["score"], merged[l]["score"])
+        }
+        merged[k] = None
+        boxes[l] = object_boxes([merged[l]])[0]
+
+    return [o for o in merged if o]
+
+
+def merge_detected_objects(objects_a, objects_b, class_categories, overlap_threshold=0.7):
+    """Adds the objects of objects_b to objects_a unless an object of objects_a shares a category with them
+    (see category_index) and overlaps them with an IoU above overlap_threshold."""
+    if len(objects_a) == 0 or len(objects_b) == 0:
+        return [*objects_a, *objects_b]
+
+    categories = sorted({c for o in [*objects_a, *objects_b] for c in class_categories.get(o["name"], ())})
+    def category_matrix(objects):
+        return torch.tensor([[c in class_categories.get(o["name"], ()) for c in categories] for o in objects], dtype=torch.float32)
+    shared_category = (category_matrix(objects_b) @ category_matrix(objects_a).T) > 0
+
+    overlapping = box_iou(object_boxes(objects_b), object_boxes(objects_a)) > overlap_threshold
+    already_present = (shared_category & overlapping).any(dim=1).tolist()
+    return [*objects_a, *[ob for ob, present in zip(objects_b, already_present) if not present]]
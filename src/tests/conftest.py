@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the packages of src are imported top level, as in eval_full_pipeline.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
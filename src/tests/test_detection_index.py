@@ -0,0 +1,71 @@
+import json
+
+import pytest
+import torch
+from transformers import CLIPTokenizer, Owlv2Config, Owlv2ForObjectDetection, Owlv2ImageProcessor, Owlv2Processor
+
+from gs_vqa.object_detection.detection_index import DetectionIndex, index_image
+from gs_vqa.object_detection.owl_vit_object_detector import OWLViTObjectDetector
+
+VOCABULARY = ["car", "dog", "man", "table", "tree", "window"]
+
+
+def save_tiny_owl(path):
+    """Saves a randomly initialized OWLv2 with a character level tokenizer, small enough to run in tests."""
+    characters = "abcdefghijklmnopqrstuvwxyz"
+    vocab = {c: i for i, c in enumerate(characters)}
+    vocab.update({f"{c}</w>": len(characters) + i for i, c in enumerate(characters)})
+    vocab.update({"<|startoftext|>": len(vocab), "<|endoftext|>": len(vocab) + 1})
+    with open(path / "vocab.json", "w") as vocab_file:
+        json.dump(vocab, vocab_file)
+    with open(path / "merges.txt", "w") as merges_file:
+        merges_file.write("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(str(path / "vocab.json"), str(path / "merges.txt"), pad_token="<|endoftext|>",
+                              model_max_length=16)
+    image_processor = Owlv2ImageProcessor(size={"height": 96, "width": 96})
+    Owlv2Processor(image_processor=image_processor, tokenizer=tokenizer).save_pretrained(path)
+
+    torch.manual_seed(0)
+    config = Owlv2Config(
+        text_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=2, vocab_size=len(vocab),
+                         max_position_embeddings=16, bos_token_id=vocab["<|startoftext|>"], eos_token_id=vocab["<|endoftext|>"],
+                         pad_token_id=vocab["<|endoftext|>"]),
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=2, image_size=96, patch_size=16),
+        projection_dim=32
+    )
+    Owlv2ForObjectDetection(config).save_pretrained(path)
+
+
+@pytest.fixture(scope="module")
+def detector(tmp_path_factory):
+    path = tmp_path_factory.mktemp("owl")
+    save_tiny_owl(path)
+    return OWLViTObjectDetector(torch.device("cpu"), model=str(path))
+
+
+class TestDetectionIndex:
+
+    @pytest.mark.parametrize("saturated", [False, True])
+    def test_matches_detector(self, detector, tmp_path, saturated):
+        class_head = detector.model.class_head
+        weight, bias = class_head.logit_scale.weight.clone(), class_head.logit_scale.bias.clone()
+        if saturated:
+            # logits far beyond the range in which the sigmoid scores of float32 differ
+            torch.nn.init.zeros_(class_head.logit_scale.weight)
+            torch.nn.init.constant_(class_head.logit_scale.bias, 200.0)
+        try:
+            image = torch.randint(0, 256, (3, 80, 120), generator=torch.Generator().manual_seed(0), dtype=torch.uint8)
+            index = DetectionIndex(str(tmp_path / "index"), vocabulary=VOCABULARY, model_id=detector.model_id)
+            index_image(detector, index, "image", image)
+            assert index.matches(detector)
+
+            query_groups = [(VOCABULARY, 0.1, 20), (["tree", "car", "man"], 0.2, 5), (["window", "dog"], 0.01, None)]
+            for indexed, detected in zip(index.detect_object_groups("image", query_groups), detector.detect_object_groups(image, query_groups)):
+                assert [o["name"] for o in indexed] == [o["name"] for o in detected]
+                for indexed_object, detected_object in zip(indexed, detected):
+                    for key in ["x", "y", "w", "h", "score"]:
+                        assert indexed_object[key] == pytest.approx(detected_object[key], abs=1e-4)
+        finally:
+            with torch.no_grad():
+                class_head.logit_scale.weight.copy_(weight)
+                class_head.logit_scale.bias.copy_(bias)
@@ -0,0 +1,26 @@
+import pytest
+
+from asp_encoding import ClingoSession
+from evaluation.benchmarks import random_scene_program, BENCHMARK_QUESTIONS
+
+class TestSoftEncoding:
+
+    @pytest.mark.parametrize("n_objects", [4, 8])
+    @pytest.mark.parametrize("seed", [0, 1, 2])
+    def test_compact_matches_pair(self, n_objects, seed):
+        scene = random_scene_program(n_objects, seed)
+        sessions = {encoding: ClingoSession(timeout=60.0, soft_encoding=encoding) for encoding in ["pair", "compact"]}
+        for question_type, question_encoding in BENCHMARK_QUESTIONS.items():
+            pair, compact = (sessions[encoding].solve_topk(scene, question_encoding, topk=3) for encoding in ["pair", "compact"])
+            assert pair["status"] == compact["status"], question_type
+            if pair["status"] != "ok":
+                # e.g. a question about a class the scene does not contain
+                continue
+
+            # the same answers and optimal cost, with the same cost differences to the optimum
+            assert pair["costs"][0] == compact["costs"][0], question_type
+            assert set(pair["answers"]) == set(compact["answers"]), question_type
+            assert pair["answers"][0] == compact["answers"][0] or pair["costs"][0] == pair["costs"][1], question_type
+            pair_costs = {answer: [c - b for c, b in zip(cost, pair["costs"][0])] for answer, cost in zip(pair["answers"], pair["costs"])}
+            compact_costs = {answer: [c - b for c, b in zip(cost, compact["costs"][0])] for answer, cost in zip(compact["answers"], compact["costs"])}
+            assert pair_costs == compact_costs, question_type